@@ -101,6 +101,16 @@ variable named:
 
 Security groups are comma-separated in 'ec2_security_group_ids' and
 'ec2_security_group_names'.
+
+To avoid starting from scratch for every Ansible run, the inventory can be
+kept in memory by a long-running process:
+
+    ./ec2.py --daemon &
+
+It refreshes the inventory whenever the cache expires and answers --list and
+--host over a Unix socket (daemon_socket in ec2.ini, by default next to the
+cache files). While it runs, ec2.py --list and ec2.py --host ask it first and
+fall back to the cache and the APIs when it does not answer.
 '''
 
 # (c) 2012, Peter Sankauskas
@@ -125,33 +135,209 @@ Security groups are comma-separated in 'ec2_security_group_ids' and
 import sys
 import os
 import argparse
+import contextlib
+import copy
+import fnmatch
+import random
 import re
-from time import time
-import boto
-from boto import ec2
-from boto import rds
-from boto import elasticache
-from boto import route53
-from boto import sts
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+from time import sleep, time
 import six
 
-from ansible.module_utils import ec2 as ec2_utils
-
+# The AWS SDK is imported by load_aws_sdk() before the first API call, so
+# serving a valid cache doesn't pay for importing it
+boto = None
+ec2 = None
+rds = None
+elasticache = None
+route53 = None
+sts = None
+ec2_utils = None
 HAS_BOTO3 = False
+
+HAS_SQLITE3 = False
+try:
+    import sqlite3
+    HAS_SQLITE3 = True
+except ImportError:
+    pass
+
+HAS_FCNTL = False
 try:
-    import boto3
-    HAS_BOTO3 = True
+    import fcntl
+    HAS_FCNTL = True
 except ImportError:
     pass
 
 from six.moves import configparser
+from six.moves import queue
+from six.moves import socketserver
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 try:
     import json
 except ImportError:
     import simplejson as json
 
+JSON_PRETTY_ENCODER = json.JSONEncoder(sort_keys=True, indent=2)
+JSON_COMPACT_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+# Patterns for to_safe and uncammelize
+UNSAFE_CHARS_RE = re.compile(r"[^A-Za-z0-9\_]")
+UNSAFE_CHARS_KEEP_DASH_RE = re.compile(r"[^A-Za-z0-9\_\-]")
+GLOB_CHARS_RE = re.compile(r"([*?\[\]])")
+CAMEL_WORD_RE = re.compile('(.)([A-Z][a-z]+)')
+CAMEL_CASE_RE = re.compile('([a-z0-9])([A-Z])')
+
+# Number of results to_safe and uncammelize remember before starting over
+SANITIZE_MEMO_SIZE = 10000
+
+# Host variables built from instance attributes that don't become a variable
+# of the same name (ec2_tags becomes one ec2_tag_* variable per tag)
+HOSTVARS_BY_ATTRIBUTE = {
+    'ec2__state': ['ec2_state', 'ec2_state_code'],
+    'ec2__previous_state': ['ec2_previous_state', 'ec2_previous_state_code'],
+    'ec2__placement': ['ec2_placement'],
+    'ec2_groups': ['ec2_security_group_ids', 'ec2_security_group_names'],
+    'ec2_block_device_mapping': ['ec2_block_devices'],
+}
+
+# Seconds to wait for the inventory daemon before building the output here
+DAEMON_TIMEOUT = 30
+
+# Seconds to wait for another process to refresh the cache before refreshing
+# it here too, and how often to check whether it is done
+REFRESH_LOCK_TIMEOUT = 120
+REFRESH_LOCK_POLL_INTERVAL = 0.1
+
+# Error codes of API calls that were throttled, and can be retried later
+THROTTLING_ERROR_CODES = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'PriorRequestNotComplete',
+    'SlowDown',
+])
+
+
+def get_umask():
+    ''' Returns the file mode creation mask of the process '''
+
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Mode of the cache files, the one open() would give them. mkstemp creates
+# files readable by their owner only, and the umask is read once, before any
+# thread could be creating files.
+CACHE_FILE_MODE = 0o666 & ~get_umask()
+
+
+def load_aws_sdk():
+    ''' Imports boto, boto3 and the Ansible EC2 helpers the first time it is
+    called '''
+
+    global boto, ec2, rds, elasticache, route53, sts, ec2_utils, HAS_BOTO3
+    if boto is not None:
+        return
+
+    from boto import ec2
+    from boto import rds
+    from boto import elasticache
+    from boto import route53
+    from boto import sts
+
+    from ansible.module_utils import ec2 as ec2_utils
+
+    try:
+        import boto3
+        HAS_BOTO3 = True
+    except ImportError:
+        pass
+
+    # Imported last, as it is what tells other threads the SDK is loaded
+    import boto
+
+
+class InventoryError(SystemExit):
+    ''' Raised by fail_with_error once the error is on stderr. Unless it is
+    caught, it exits like sys.exit(1). '''
+
+    def __init__(self, message):
+        super(InventoryError, self).__init__(1)
+        self.message = message
+
+
+def get_error_code(error):
+    ''' Returns the AWS error code of a boto or boto3 exception, if any '''
+
+    error_code = getattr(error, 'error_code', None)
+    if error_code is None:
+        response = getattr(error, 'response', None)
+        if isinstance(response, dict):
+            error_code = response.get('Error', {}).get('Code')
+    return error_code
+
+
+class ChildGroups(list):
+    ''' List of child group names that also keeps a set of its elements, so
+    membership checks don't scan the list. It serializes as a plain list. '''
+
+    def __init__(self, *args):
+        super(ChildGroups, self).__init__(*args)
+        self.members = set(self)
+
+    def __contains__(self, element):
+        return element in self.members
+
+    def append(self, element):
+        self.members.add(element)
+        super(ChildGroups, self).append(element)
+
+
+class CountingWriter(object):
+    ''' File object that passes writes on to another one, counting the
+    characters written '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        self.stream.write(data)
+
+
+class InventoryRequestHandler(socketserver.StreamRequestHandler):
+    ''' Answers a single request line of the client shim: "list" or
+    "host <name>" '''
+
+    def handle(self):
+        request = self.rfile.readline().decode('utf-8').strip()
+        response = self.server.inventory.answer_daemon_request(request)
+        self.wfile.write(response.encode('utf-8'))
+
+
+class InventoryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    ''' Serves the inventory kept in memory by ec2.py --daemon '''
+
+    daemon_threads = True
+
+    def __init__(self, path, inventory):
+        socketserver.UnixStreamServer.__init__(self, path, InventoryRequestHandler)
+        self.inventory = inventory
+
 
 class Ec2Inventory(object):
 
@@ -161,6 +347,8 @@ class Ec2Inventory(object):
     def __init__(self):
         ''' Main execution path '''
 
+        start = time()
+
         # Inventory grouped by instance IDs, tags, security groups, regions,
         # and availability zones
         self.inventory = self._empty_inventory()
@@ -176,44 +364,198 @@ class Ec2Inventory(object):
         # AWS credentials.
         self.credentials = {}
 
+        # Connections and assumed role credentials reused across regions
+        # and services, keyed by (service, region, profile, role)
+        self.connections = {}
+        self.role_credentials = {}
+        self.account_ids = {}
+        self.connection_lock = threading.RLock()
+
+        # Results of to_safe and uncammelize, which are called with the same
+        # tag keys, group names and attribute names for every host
+        self.to_safe_memo = {}
+        self.uncammelize_memo = {}
+        self.hostvar_wanted_memo = {}
+
+        # A single copy of each string value of the host variables, most of
+        # which (regions, AMIs, VPCs, security groups...) repeat across hosts
+        self.shared_values = {}
+
+        # Counters reported with --stats
+        self.stats = defaultdict(int)
+        self.stats_lock = threading.Lock()
+
+        # (region, service) pair being fetched, which API calls are also
+        # counted under
+        self.current_shard = None
+
+        # Serialized --list output and host variables served by --daemon
+        self.daemon_state = None
+
         # Read settings and parse CLI arguments
-        self.parse_cli_args()
-        self.read_settings()
+        with self.timed('phase.settings'):
+            self.parse_cli_args()
+            self.read_settings()
 
-        # Make sure that profile_name is not passed at all if not set
-        # as pre 2.24 boto will fall over otherwise
-        if self.boto_profile:
-            if not hasattr(boto.ec2.EC2Connection, 'profile_name'):
-                self.fail_with_error("boto version must be >= 2.24 to use profile")
+        if self.args.revalidate:
+            self.revalidate_cache()
+            return
+
+        # Let a running daemon answer from memory
+        if not (self.args.daemon or self.args.refresh_cache or self.args.live or self.args.stats or self.args.changes
+                or self.args.groups):
+            response = self.request_from_daemon()
+            if response is not None:
+                print(response)
+                return
+
+        if self.args.daemon:
+            self.run_daemon()
+            return
 
         # Cache
         if self.args.refresh_cache:
             self.do_api_calls_update_cache()
         elif not self.is_cache_valid():
-            self.do_api_calls_update_cache()
+            if self.is_cache_servable_stale():
+                self.count('cache.served_stale')
+                self.start_revalidation()
+            else:
+                self.update_expired_cache()
 
         # Data to print
-        if self.args.host:
-            data_to_print = self.get_host_info()
+        with self.timed('phase.output'):
+            output = CountingWriter(sys.stdout)
+            if self.args.host:
+                output.write(self.get_host_info() + '\n')
+
+            elif self.args.changes:
+                output.write(self.get_changes_from_cache() + '\n')
+
+            elif self.args.list:
+                # Display list of instances for inventory
+                if self.args.groups:
+                    self.write_json(self.get_inventory_of_groups(self.args.groups), output)
+                elif self.inventory == self._empty_inventory():
+                    self.write_inventory_from_cache(output)
+                else:
+                    self.write_json(self.inventory, output)
+                output.write('\n')
+        self.count('output.bytes', output.size)
 
-        elif self.args.list:
-            # Display list of instances for inventory
-            if self.inventory == self._empty_inventory():
-                data_to_print = self.get_inventory_from_cache()
-            else:
-                data_to_print = self.json_format_dict(self.inventory, True)
+        if self.args.stats or self.stats_file:
+            self.count('phase.total.seconds', time() - start)
+            self.write_stats()
+
+    def get_cache_age(self):
+        ''' Returns the age of the cache in seconds, or None if there is no
+        cache '''
+
+        if self.cache_backend == 'sqlite':
+            if os.path.isfile(self.cache_path_db):
+                return time() - os.path.getmtime(self.cache_path_db)
+            return None
 
-        print(data_to_print)
+        if os.path.isfile(self.cache_path_cache) and os.path.isfile(self.cache_path_index):
+            return time() - os.path.getmtime(self.cache_path_cache)
+
+        return None
 
     def is_cache_valid(self):
         ''' Determines if the cache files have expired, or if it is still valid '''
 
-        if os.path.isfile(self.cache_path_cache):
-            mod_time = os.path.getmtime(self.cache_path_cache)
+        cache_age = self.get_cache_age()
+        return cache_age is not None and cache_age < self.cache_merged_max_age
+
+    def is_cache_servable_stale(self):
+        ''' Determines if an expired cache is recent enough to be served while
+        it is refreshed in the background '''
+
+        cache_age = self.get_cache_age()
+        return cache_age is not None and cache_age < self.cache_stale_max_age
+
+    def lock_refresh(self, timeout=0):
+        ''' Takes the refresh lock, shared by all the processes using this
+        cache. Returns the locked file, which releases the lock when closed,
+        or None if another process still holds the lock after timeout
+        seconds. '''
+
+        deadline = time() + timeout
+        lock = open(self.cache_path_lock, 'a')
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock
+            except IOError:
+                if time() >= deadline:
+                    lock.close()
+                    return None
+            sleep(REFRESH_LOCK_POLL_INTERVAL)
+
+    def update_expired_cache(self):
+        ''' Refreshes the expired cache, while holding the refresh lock so
+        that processes started together don't all call the APIs. Whoever
+        gets the lock last finds the cache refreshed and just reads it. If
+        the lock is still held after REFRESH_LOCK_TIMEOUT seconds, the process
+        holding it is assumed to be stuck and the cache is refreshed here
+        without the lock. '''
+
+        if not HAS_FCNTL:
+            self.do_api_calls_update_cache()
+            return
+
+        lock = self.lock_refresh(REFRESH_LOCK_TIMEOUT)
+        if lock is None:
+            self.count('cache.lock_timeouts')
+            self.do_api_calls_update_cache()
+            return
+        try:
+            if self.is_cache_valid():
+                self.count('cache.refreshed_elsewhere')
+            else:
+                self.do_api_calls_update_cache()
+        finally:
+            lock.close()
+
+    def start_revalidation(self):
+        ''' Starts a detached ec2.py --revalidate to refresh the cache, unless
+        a refresh is already running '''
+
+        lock = self.lock_refresh()
+        if lock is None:
+            return
+        lock.close()
+
+        command = [sys.executable, os.path.abspath(__file__), '--revalidate']
+        if self.args.boto_profile:
+            command.extend(['--profile', self.args.boto_profile])
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull,
+                             close_fds=True, preexec_fn=os.setsid)
+
+    def revalidate_cache(self):
+        ''' Refreshes the cache while holding the refresh lock, unless another
+        process holds it or has refreshed the cache already '''
+
+        lock = self.lock_refresh()
+        if lock is None:
+            return
+        try:
+            if not self.is_cache_valid():
+                self.do_api_calls_update_cache()
+        finally:
+            lock.close()
+
+    def is_shard_cache_valid(self, shard):
+        ''' Determines if the cache file of a (region, service) pair has
+        expired, or if it is still valid '''
+
+        cache_path = self.cache_path_shard % shard
+        if os.path.isfile(cache_path):
+            mod_time = os.path.getmtime(cache_path)
             current_time = time()
-            if (mod_time + self.cache_max_age) > current_time:
-                if os.path.isfile(self.cache_path_index):
-                    return True
+            if (mod_time + self.cache_shard_max_age[shard[1]]) > current_time:
+                return True
 
         return False
 
@@ -251,18 +593,12 @@ class Ec2Inventory(object):
         if self.eucalyptus and config.has_option('ec2', 'eucalyptus_host'):
             self.eucalyptus_host = config.get('ec2', 'eucalyptus_host')
 
-        # Regions
+        # Regions ('all' is resolved by prepare_api_calls, as it needs boto)
         self.regions = []
         configRegions = config.get('ec2', 'regions')
-        if (configRegions == 'all'):
-            if self.eucalyptus_host:
-                self.regions.append(boto.connect_euca(host=self.eucalyptus_host).region.name, **self.credentials)
-            else:
-                configRegions_exclude = config.get('ec2', 'regions_exclude')
-                for regionInfo in ec2.regions():
-                    if regionInfo.name not in configRegions_exclude:
-                        self.regions.append(regionInfo.name)
-        else:
+        self.all_regions = (configRegions == 'all')
+        self.regions_exclude = config.get('ec2', 'regions_exclude')
+        if not self.all_regions:
             self.regions = configRegions.split(",")
         if 'auto' in self.regions:
             env_region = os.environ.get('AWS_REGION')
@@ -298,6 +634,19 @@ class Ec2Inventory(object):
             self.route53_excluded_zones.extend(
                 config.get('ec2', 'route53_excluded_zones', '').split(','))
 
+        # Keep the records of each Route53 zone in a cache file and only list
+        # them again when the zone's record count changes, or at least every
+        # route53_zone_cache_max_age seconds (default: 3600), as updating a
+        # record in place keeps the count
+        if config.has_option('ec2', 'route53_zone_cache'):
+            self.route53_zone_cache = config.getboolean('ec2', 'route53_zone_cache')
+        else:
+            self.route53_zone_cache = False
+        if config.has_option('ec2', 'route53_zone_cache_max_age'):
+            self.route53_zone_cache_max_age = config.getint('ec2', 'route53_zone_cache_max_age')
+        else:
+            self.route53_zone_cache_max_age = 3600
+
         # Include RDS instances?
         self.rds_enabled = True
         if config.has_option('ec2', 'rds'):
@@ -405,15 +754,150 @@ class Ec2Inventory(object):
         cache_id = self.boto_profile or os.environ.get('AWS_ACCESS_KEY_ID', self.credentials.get('aws_access_key_id'))
         if cache_id:
             cache_name = '%s-%s' % (cache_name, cache_id)
-        self.cache_path_cache = os.path.join(cache_dir, "%s.cache" % cache_name)
         self.cache_path_index = os.path.join(cache_dir, "%s.index" % cache_name)
+        self.cache_path_groups = os.path.join(cache_dir, "%s.groups" % cache_name)
+        self.cache_path_hostvars = os.path.join(cache_dir, "%s.hostvars" % cache_name)
+        self.cache_path_hostvars_index = os.path.join(cache_dir, "%s.hostvars-index" % cache_name)
         self.cache_max_age = config.getint('ec2', 'cache_max_age')
 
+        # Encoding of the JSON inventory cache: 'plain' JSON, or 'shared',
+        # which writes every distinct host variable name and value once and
+        # has the hosts refer to them. It makes the cache much smaller, at
+        # the cost of decoding it for --list.
+        if config.has_option('ec2', 'cache_encoding'):
+            self.cache_encoding = config.get('ec2', 'cache_encoding')
+        else:
+            self.cache_encoding = 'plain'
+        if self.cache_encoding not in ['plain', 'shared']:
+            self.fail_with_error("cache_encoding must be 'plain' or 'shared', not '%s'" % self.cache_encoding)
+        if self.cache_encoding == 'shared':
+            self.cache_path_cache = os.path.join(cache_dir, "%s.shared-cache" % cache_name)
+        else:
+            self.cache_path_cache = os.path.join(cache_dir, "%s.cache" % cache_name)
+
+        # Until the cache is this old, serve it once it expires and refresh it
+        # in a detached process, so that only older caches make a run wait
+        # for the APIs (default: 0, always wait)
+        if config.has_option('ec2', 'cache_stale_max_age'):
+            self.cache_stale_max_age = config.getint('ec2', 'cache_stale_max_age')
+        else:
+            self.cache_stale_max_age = 0
+        if self.cache_stale_max_age and not HAS_FCNTL:
+            self.fail_with_error("cache_stale_max_age requires the fcntl module")
+        self.cache_path_lock = os.path.join(cache_dir, "%s.lock" % cache_name)
+
+        # Cache format: 'json' files, or a single indexed 'sqlite' database
+        # that lets --host read one row instead of the whole inventory
+        if config.has_option('ec2', 'cache_backend'):
+            self.cache_backend = config.get('ec2', 'cache_backend')
+        else:
+            self.cache_backend = 'json'
+        if self.cache_backend not in ['json', 'sqlite']:
+            self.fail_with_error("cache_backend must be 'json' or 'sqlite', not '%s'" % self.cache_backend)
+        if self.cache_backend == 'sqlite' and not HAS_SQLITE3:
+            self.fail_with_error("The sqlite cache backend requires the sqlite3 module")
+        self.cache_path_db = os.path.join(cache_dir, "%s.db" % cache_name)
+
+        # Write compact JSON in insertion order instead of indented JSON
+        # with sorted keys
+        if config.has_option('ec2', 'json_compact'):
+            self.json_compact = config.getboolean('ec2', 'json_compact')
+        else:
+            self.json_compact = False
+
+        # Cache every (region, service) pair in its own file and only refetch
+        # the ones that have expired
+        if config.has_option('ec2', 'cache_shards'):
+            self.cache_shards = config.getboolean('ec2', 'cache_shards')
+        else:
+            self.cache_shards = False
+        self.cache_path_shard = os.path.join(cache_dir, "%s-%%s-%%s.shard" % cache_name)
+
+        # When a (region, service) pair fails, use its last shard file and
+        # list it in _meta.stale_shards instead of failing the whole
+        # inventory. Shard files are then written even without cache_shards.
+        if config.has_option('ec2', 'degraded_mode'):
+            self.degraded_mode = config.getboolean('ec2', 'degraded_mode')
+        else:
+            self.degraded_mode = False
+
+        self.cache_path_route53 = os.path.join(cache_dir, "%s.route53" % cache_name)
+
+        # After every refresh, write the hosts added, removed and modified
+        # since the previous one to a .changes file next to the cache, which
+        # --changes prints. --changes --refresh-cache does it regardless.
+        if config.has_option('ec2', 'change_feed'):
+            self.change_feed = config.getboolean('ec2', 'change_feed')
+        else:
+            self.change_feed = False
+        self.cache_path_changes = os.path.join(cache_dir, "%s.changes" % cache_name)
+
+        # File the --stats counters of every run are written to, whether or
+        # not --stats is given (default: none). The EC2_STATS_FILE
+        # environment variable takes precedence.
+        if os.environ.get('EC2_STATS_FILE'):
+            self.stats_file = os.path.expanduser(os.path.expandvars(os.environ['EC2_STATS_FILE']))
+        elif config.has_option('ec2', 'stats_file'):
+            self.stats_file = os.path.expanduser(os.path.expandvars(config.get('ec2', 'stats_file')))
+        else:
+            self.stats_file = None
+
+        # Unix socket of the inventory daemon, which --list and --host ask
+        # first whenever it exists
+        if config.has_option('ec2', 'daemon_socket'):
+            self.daemon_socket = os.path.expanduser(os.path.expandvars(config.get('ec2', 'daemon_socket')))
+        else:
+            self.daemon_socket = os.path.join(cache_dir, "%s.sock" % cache_name)
+
+        # Shard lifetime per service (default: cache_max_age)
+        self.cache_shard_max_age = {}
+        for service in ['ec2', 'rds', 'elasticache', 'rds_clusters']:
+            option = 'cache_max_age_' + service
+            if config.has_option('ec2', option):
+                self.cache_shard_max_age[service] = config.getint('ec2', option)
+            else:
+                self.cache_shard_max_age[service] = self.cache_max_age
+
+        # Lifetime of the merged cache. With cache_shards, it expires with
+        # the first shard that does, so the next run refetches that shard and
+        # reuses the others.
+        if self.cache_shards:
+            services = ['ec2']
+            if self.rds_enabled:
+                services.append('rds')
+            if self.elasticache_enabled:
+                services.append('elasticache')
+            if self.include_rds_clusters:
+                services.append('rds_clusters')
+            self.cache_merged_max_age = min(self.cache_shard_max_age[service] for service in services)
+        else:
+            self.cache_merged_max_age = self.cache_max_age
+
+        # Once the inventory of the daemon is this old, because its refreshes
+        # keep failing, it stops answering and clients build the inventory
+        # themselves (default: cache_stale_max_age, or twice the lifetime of
+        # the cache if that is longer)
+        if config.has_option('ec2', 'daemon_max_age'):
+            self.daemon_max_age = config.getint('ec2', 'daemon_max_age')
+        else:
+            self.daemon_max_age = max(self.cache_stale_max_age, 2 * self.cache_merged_max_age)
+
         if config.has_option('ec2', 'expand_csv_tags'):
             self.expand_csv_tags = config.getboolean('ec2', 'expand_csv_tags')
         else:
             self.expand_csv_tags = False
 
+        # Host variables to keep, as comma-separated shell-style patterns
+        # (e.g. ec2_tag_*, ec2_private_ip_address): those matching
+        # hostvars_include (default: all) and not hostvars_exclude
+        self.hostvars_include = []
+        self.hostvars_exclude = []
+        for option, patterns in [('hostvars_include', self.hostvars_include),
+                                 ('hostvars_exclude', self.hostvars_exclude)]:
+            if config.has_option('ec2', option):
+                patterns.extend(pattern.strip() for pattern in config.get('ec2', option).split(',') if pattern.strip())
+        self.hostvars_projected = bool(self.hostvars_include or self.hostvars_exclude)
+
         # Configure nested groups instead of flat namespace.
         if config.has_option('ec2', 'nested_groups'):
             self.nested_groups = config.getboolean('ec2', 'nested_groups')
@@ -501,6 +985,61 @@ class Ec2Inventory(object):
                     continue
                 self.ec2_instance_filters[filter_key].append(filter_value)
 
+        # Number of (region, service) pairs fetched concurrently
+        if config.has_option('ec2', 'fetch_workers'):
+            self.fetch_workers = max(1, config.getint('ec2', 'fetch_workers'))
+        else:
+            self.fetch_workers = 8
+
+        # Number of concurrent tag lookups within each (region, service) pair
+        if config.has_option('ec2', 'tag_fetch_workers'):
+            self.tag_fetch_workers = max(1, config.getint('ec2', 'tag_fetch_workers'))
+        else:
+            self.tag_fetch_workers = 4
+
+        # Concurrent API calls allowed per service, across all regions
+        # (default: 16), and for one service with api_concurrency_<service>
+        if config.has_option('ec2', 'api_concurrency'):
+            api_concurrency = max(1, config.getint('ec2', 'api_concurrency'))
+        else:
+            api_concurrency = 16
+        self.api_semaphores = {}
+        for service in ['ec2', 'rds', 'elasticache', 'route53', 'sts']:
+            option = 'api_concurrency_' + service
+            if config.has_option('ec2', option):
+                limit = max(1, config.getint('ec2', option))
+            else:
+                limit = api_concurrency
+            self.api_semaphores[service] = threading.BoundedSemaphore(limit)
+
+        # Retries of throttled API calls, waiting a random time of up to
+        # api_retry_delay seconds, doubled for every retry and capped at
+        # api_retry_max_delay seconds
+        if config.has_option('ec2', 'api_max_retries'):
+            self.api_max_retries = config.getint('ec2', 'api_max_retries')
+        else:
+            self.api_max_retries = 5
+        if config.has_option('ec2', 'api_retry_delay'):
+            self.api_retry_delay = config.getfloat('ec2', 'api_retry_delay')
+        else:
+            self.api_retry_delay = 0.5
+        if config.has_option('ec2', 'api_retry_max_delay'):
+            self.api_retry_max_delay = config.getfloat('ec2', 'api_retry_max_delay')
+        else:
+            self.api_retry_max_delay = 20.0
+
+        # How EC2 instance tags are fetched:
+        #  - sweep: get_all_tags for every instance (tags returned with the
+        #    instances are documented as unreliable)
+        #  - verify: get_all_tags only for instances returned without tags
+        #  - inline: trust the tags returned with the instances
+        if config.has_option('ec2', 'tag_fetch_strategy'):
+            self.tag_fetch_strategy = config.get('ec2', 'tag_fetch_strategy')
+        else:
+            self.tag_fetch_strategy = 'sweep'
+        if self.tag_fetch_strategy not in ['sweep', 'verify', 'inline']:
+            self.fail_with_error("tag_fetch_strategy must be 'sweep', 'verify' or 'inline', not '%s'" % self.tag_fetch_strategy)
+
     def parse_cli_args(self):
         ''' Command line argument processing '''
 
@@ -509,30 +1048,359 @@ class Ec2Inventory(object):
                             help='List instances (default: True)')
         parser.add_argument('--host', action='store',
                             help='Get all the variables about a specific instance')
+        parser.add_argument('--live', action='store_true', default=False,
+                            help='With --host, get the variables with an API call instead of the cache (default: False)')
         parser.add_argument('--refresh-cache', action='store_true', default=False,
                             help='Force refresh of cache by making API requests to EC2 (default: False - use cache files)')
         parser.add_argument('--profile', '--boto-profile', action='store', dest='boto_profile',
                             help='Use boto profile for connections to EC2')
+        parser.add_argument('--group', action='append', dest='groups', metavar='PATTERN',
+                            help='With --list, only list the groups matching this shell-style pattern (e.g. '
+                                 'tag_Name_web, security_group_*), their child groups and their hosts. May be repeated.')
+        parser.add_argument('--changes', action='store_true', default=False,
+                            help='Print the hosts added, removed and modified by the last refresh (default: False)')
+        parser.add_argument('--stats', action='store_true', default=False,
+                            help='Write inventory statistics as JSON to stderr (default: False)')
+        parser.add_argument('--daemon', action='store_true', default=False,
+                            help='Keep the inventory in memory and answer --list and --host over a Unix socket (default: False)')
+        parser.add_argument('--revalidate', action='store_true', default=False,
+                            help=argparse.SUPPRESS)
         self.args = parser.parse_args()
 
-    def do_api_calls_update_cache(self):
-        ''' Do API calls to each region, and save data in cache files '''
+    def prepare_api_calls(self):
+        ''' Imports the AWS SDK and resolves the settings that depend on it.
+        Called before any API call. '''
+
+        load_aws_sdk()
+
+        # Make sure that profile_name is not passed at all if not set
+        # as pre 2.24 boto will fall over otherwise
+        if self.boto_profile:
+            if not hasattr(boto.ec2.EC2Connection, 'profile_name'):
+                self.fail_with_error("boto version must be >= 2.24 to use profile")
+
+        if self.all_regions and not self.regions:
+            if self.eucalyptus_host:
+                self.regions.append(boto.connect_euca(host=self.eucalyptus_host).region.name, **self.credentials)
+            else:
+                for regionInfo in ec2.regions():
+                    if regionInfo.name not in self.regions_exclude:
+                        self.regions.append(regionInfo.name)
+
+    def do_api_calls_update_cache(self, force=False):
+        ''' Do API calls to each region, and save data in cache files. With
+        force (or --refresh-cache), shards that are still cached are fetched
+        again too. '''
+
+        force = force or self.args.refresh_cache
+
+        with self.timed('phase.refresh'):
+            self.prepare_api_calls()
+
+            if self.route53_enabled:
+                with self.timed('phase.route53'):
+                    self.get_route53_records()
+
+            # Shards are fetched while earlier ones are merged, so the fetch
+            # phase includes the merge phase
+            self.stale_shards = []
+            shards = self.get_shards()
+            with self.timed('phase.fetch'):
+                for shard in self.fetch_shards(shards, force):
+                    with self.timed('phase.merge'):
+                        self.merge_shard(shard)
+
+            if self.stale_shards:
+                if len(self.stale_shards) == len(shards) and not any(stale['cached'] for stale in self.stale_shards):
+                    self.fail_with_error("No region or service could be fetched, and none was cached")
+                self.inventory['_meta']['stale_shards'] = self.stale_shards
+
+            # Compare with the cache before it is replaced
+            changes = None
+            if self.change_feed or self.args.changes:
+                with self.timed('phase.changes'):
+                    cache_age = self.get_cache_age()
+                    if cache_age is None:
+                        changes = self.get_changes(self._empty_inventory(), self.inventory)
+                        changes['since'] = None
+                    else:
+                        changes = self.get_changes(self.load_inventory_from_cache(), self.inventory)
+                        changes['since'] = int(time() - cache_age)
+
+            with self.timed('phase.cache_write'):
+                if self.cache_backend == 'sqlite':
+                    self.write_to_sqlite_cache()
+                else:
+                    # The indexes go first, as the age of the cache is that
+                    # of the inventory file
+                    self.write_to_cache(self.index, self.cache_path_index)
+                    self.write_to_cache(self.get_groups(self.inventory), self.cache_path_groups)
+                    self.write_hostvars_to_cache(self.inventory['_meta']['hostvars'])
+                    if self.cache_encoding == 'shared':
+                        self.write_to_cache(self.encode_shared_values(self.inventory), self.cache_path_cache,
+                                            compact=True)
+                    else:
+                        self.write_to_cache(self.inventory, self.cache_path_cache)
+
+                if changes is not None:
+                    self.write_to_cache(changes, self.cache_path_changes)
 
-        if self.route53_enabled:
-            self.get_route53_records()
+    def get_shards(self):
+        ''' Lists the (region, service) pairs to fetch, in the order their
+        results are merged into the inventory '''
 
+        shards = []
         for region in self.regions:
-            self.get_instances_by_region(region)
+            shards.append((region, 'ec2'))
             if self.rds_enabled:
-                self.get_rds_instances_by_region(region)
+                shards.append((region, 'rds'))
             if self.elasticache_enabled:
-                self.get_elasticache_clusters_by_region(region)
-                self.get_elasticache_replication_groups_by_region(region)
+                shards.append((region, 'elasticache'))
             if self.include_rds_clusters:
-                self.include_rds_clusters_by_region(region)
+                shards.append((region, 'rds_clusters'))
+        return shards
+
+    def fetch_shards(self, shards, force=False):
+        ''' Fetches shards using up to fetch_workers threads and yields their
+        inventory fragments in the order the shards were given. Shards still
+        cached are reused unless force is set. '''
+
+        if self.fetch_workers == 1 or len(shards) < 2:
+            for shard in shards:
+                error, fragment = self.fetch_shard_safely(shard, force)
+                if error is not None:
+                    fragment = self.recover_shard(shard, error)
+                yield fragment
+            return
+
+        def fetch(shard):
+            return self.fetch_shard_safely(shard, force)
+
+        pool = ThreadPool(min(self.fetch_workers, len(shards)))
+        try:
+            for shard, (error, fragment) in zip(shards, pool.imap(fetch, shards)):
+                if error is not None:
+                    fragment = self.recover_shard(shard, error)
+                yield fragment
+        finally:
+            pool.terminate()
+
+    def fetch_shard_safely(self, shard, force=False):
+        ''' Runs fetch_shard, returning any error instead of raising it, and
+        counts the time it took per shard, region and service '''
+
+        start = time()
+        # fail_with_error exits through SystemExit, which would kill the
+        # worker thread instead of reaching the main thread
+        try:
+            return None, self.fetch_shard(shard, force)
+        except BaseException as e:
+            return e, None
+        finally:
+            elapsed = time() - start
+            self.count('shards.%s.%s.seconds' % shard, elapsed)
+            self.count('regions.%s.seconds' % shard[0], elapsed)
+            self.count('services.%s.seconds' % shard[1], elapsed)
+
+    def recover_shard(self, shard, error):
+        ''' In degraded mode, returns the last cached fragment of a shard that
+        failed (or an empty one) and records it in self.stale_shards.
+        Raises the error otherwise. '''
+
+        if not self.degraded_mode or not isinstance(error, (Exception, InventoryError)):
+            raise error
+
+        if isinstance(error, InventoryError):
+            # fail_with_error has already written the message
+            message = error.message
+            sys.stderr.write('\n')
+        else:
+            message = '%s: %s' % (type(error).__name__, error)
+            sys.stderr.write('ERROR: %s\n' % message)
+
+        region, service = shard
+        stale = {
+            'region': region,
+            'service': service,
+            'error': message,
+            'cached': os.path.isfile(self.cache_path_shard % shard),
+        }
+        if stale['cached']:
+            stale['cache_age'] = int(time() - os.path.getmtime(self.cache_path_shard % shard))
+            fragment = self.load_shard_from_cache(shard)
+        else:
+            fragment = {
+                'region': region,
+                'service': service,
+                'inventory': self._empty_inventory(),
+                'index': {},
+                'aws_account_id': None,
+            }
+
+        self.stale_shards.append(stale)
+        self.count('shards.stale')
+        return fragment
+
+    def call_api(self, service, func, *args, **kwargs):
+        ''' Calls an API function once the concurrency limit of its service
+        allows it, retrying throttled calls with jittered exponential
+        backoff. Attempts, latency, throttles and retries are counted per
+        operation. '''
+
+        operation = '%s.%s' % (service, func.__name__)
+        if self.current_shard:
+            region_operation = 'regions.%s.%s' % (self.current_shard[0], operation)
+        else:
+            region_operation = None
+        retries = 0
+        while True:
+            with self.api_semaphores[service]:
+                start = time()
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    if get_error_code(e) not in THROTTLING_ERROR_CODES:
+                        raise
+                    self.count(operation + '.throttled')
+                    if retries >= self.api_max_retries:
+                        raise
+                finally:
+                    elapsed = time() - start
+                    self.count(operation + '.attempts')
+                    self.count(operation + '.seconds', elapsed)
+                    if region_operation:
+                        self.count(region_operation + '.attempts')
+                        self.count(region_operation + '.seconds', elapsed)
+
+            retries += 1
+            self.count(operation + '.retries')
+            delay = random.uniform(0, min(self.api_retry_max_delay, self.api_retry_delay * 2 ** retries))
+            self.count('api.backoff.seconds', delay)
+            sleep(delay)
+
+    def map_concurrently(self, func, items):
+        ''' Calls func on every item using up to tag_fetch_workers threads and
+        returns the results in the order of the items '''
+
+        if self.tag_fetch_workers == 1 or len(items) < 2:
+            return [func(item) for item in items]
+
+        pool = ThreadPool(min(self.tag_fetch_workers, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.terminate()
+
+    def prefetch(self, items, stop):
+        ''' Consumes an iterable in a background thread and returns a
+        generator of its items, so they are fetched while the caller does
+        something else. At most one item is fetched ahead of the generator,
+        and the thread stops between items once the stop event is set, so
+        a caller that gives up doesn't leave it fetching. Errors are raised
+        by the generator. '''
+
+        fetched = queue.Queue(maxsize=1)
+        done = object()
+
+        def put(entry):
+            # Waits for the consumer, unless it has stopped consuming
+            while not stop.is_set():
+                try:
+                    fetched.put(entry, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            # fail_with_error exits through SystemExit, which would kill the
+            # thread instead of reaching the consumer
+            try:
+                for item in items:
+                    if not put((None, item)):
+                        return
+            except BaseException as e:
+                put((e, None))
+            else:
+                put((None, done))
+
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+
+        def consume():
+            while True:
+                error, item = fetched.get()
+                if error is not None:
+                    raise error
+                if item is done:
+                    return
+                yield item
+
+        return consume()
+
+    def fetch_shard(self, shard, force=False):
+        ''' Fetches a single (region, service) pair into its own inventory
+        fragment, leaving self.inventory and self.index untouched '''
+
+        region, service = shard
+
+        if self.cache_shards and not force and self.is_shard_cache_valid(shard):
+            return self.load_shard_from_cache(shard)
+
+        builder = copy.copy(self)
+        builder.inventory = self._empty_inventory()
+        builder.index = {}
+        builder.current_shard = shard
+
+        if service == 'ec2':
+            builder.get_instances_by_region(region)
+        elif service == 'rds':
+            builder.get_rds_instances_by_region(region)
+        elif service == 'elasticache':
+            builder.get_elasticache_by_region(region)
+        elif service == 'rds_clusters':
+            builder.include_rds_clusters_by_region(region)
+
+        fragment = {
+            'region': region,
+            'service': service,
+            'inventory': builder.inventory,
+            'index': builder.index,
+            'aws_account_id': builder.aws_account_id,
+        }
+
+        if self.cache_shards or self.degraded_mode:
+            self.write_to_cache(fragment, self.cache_path_shard % shard)
+
+        return fragment
+
+    def merge_shard(self, shard):
+        ''' Merges a shard's inventory fragment into the inventory and index,
+        as if its hosts had been added directly '''
+
+        if not self.aws_account_id:
+            self.aws_account_id = shard['aws_account_id']
+
+        for key, value in shard['inventory'].items():
+            if key == '_meta':
+                for hostname, host_info in value['hostvars'].items():
+                    # Shards fetched before any EC2 shard knew the account ID
+                    if 'ec2_account_id' in host_info and host_info['ec2_account_id'] is None:
+                        host_info['ec2_account_id'] = self.aws_account_id
+                    self.inventory['_meta']['hostvars'][hostname] = host_info
+            elif key == 'db_clusters':
+                self.inventory[key] = value
+            elif isinstance(value, dict):
+                for element in value.get('hosts', []):
+                    self.push(self.inventory, key, element)
+                for element in value.get('children', []):
+                    self.push_group(self.inventory, key, element)
+            else:
+                for element in value:
+                    self.push(self.inventory, key, element)
 
-        self.write_to_cache(self.inventory, self.cache_path_cache)
-        self.write_to_cache(self.index, self.cache_path_index)
+        self.index.update(shard['index'])
 
     def connect(self, region):
         ''' create connection to api server'''
@@ -551,25 +1419,93 @@ class Ec2Inventory(object):
         return connect_args
 
     def connect_to_aws(self, module, region):
-        connect_args = self.credentials
+        ''' Returns a boto connection to a region, reusing an earlier one as
+        long as the credentials it was made with are still valid '''
+
+        service = module.__name__.split('.')[-1]
+        key = (service, region, self.boto_profile, self.iam_role)
+        conn = self.get_pooled_connection(key)
+        if conn is not None:
+            return conn
+
+        connect_args, role_credentials = self.get_connect_args(region)
+        conn = module.connect_to_region(region, **connect_args)
+        # connect_to_region will fail "silently" by returning None if the region name is wrong or not supported
+        if conn is None:
+            self.fail_with_error("region name: %s likely not supported, or AWS is down.  connection to region failed." % region)
+        self.add_pooled_connection(key, conn, role_credentials)
+        return conn
+
+    def connect_to_boto3(self, resource, region):
+        ''' Returns a boto3 client for a region, pooled like connect_to_aws '''
+
+        key = ('boto3.' + resource, region, self.boto_profile, self.iam_role)
+        client = self.get_pooled_connection(key)
+        if client is not None:
+            return client
+
+        connect_args, role_credentials = self.get_connect_args(region)
+        client = ec2_utils.boto3_inventory_conn('client', resource, region, **connect_args)
+        self.add_pooled_connection(key, client, role_credentials)
+        return client
+
+    def get_pooled_connection(self, key):
+        ''' Returns the pooled connection for a key, or None if there is none
+        or the role credentials it uses are about to expire '''
+
+        with self.connection_lock:
+            conn, role_credentials = self.connections.get(key, (None, None))
+        if conn is not None and not self.role_credentials_expiring(role_credentials):
+            self.count('connections.%s.reused' % key[0])
+            return conn
+        return None
+
+    def add_pooled_connection(self, key, conn, role_credentials):
+        ''' Adds a connection to the pool, with the role credentials it uses '''
+
+        with self.connection_lock:
+            self.connections[key] = (conn, role_credentials)
+        self.count('connections.%s.created' % key[0])
+
+    def get_connect_args(self, region):
+        ''' Builds the connection arguments for a region, and returns them with
+        the assumed role credentials they contain (if any) '''
+
+        connect_args = dict(self.credentials)
 
         # only pass the profile name if it's set (as it is not supported by older boto versions)
         if self.boto_profile:
             connect_args['profile_name'] = self.boto_profile
             self.boto_fix_security_token_in_profile(connect_args)
 
+        role_credentials = None
         if self.iam_role:
-            sts_conn = sts.connect_to_region(region, **connect_args)
-            role = sts_conn.assume_role(self.iam_role, 'ansible_dynamic_inventory')
-            connect_args['aws_access_key_id'] = role.credentials.access_key
-            connect_args['aws_secret_access_key'] = role.credentials.secret_key
-            connect_args['security_token'] = role.credentials.session_token
+            role_credentials = self.assume_role(region, connect_args)
+            connect_args['aws_access_key_id'] = role_credentials.access_key
+            connect_args['aws_secret_access_key'] = role_credentials.secret_key
+            connect_args['security_token'] = role_credentials.session_token
 
-        conn = module.connect_to_region(region, **connect_args)
-        # connect_to_region will fail "silently" by returning None if the region name is wrong or not supported
-        if conn is None:
-            self.fail_with_error("region name: %s likely not supported, or AWS is down.  connection to region failed." % region)
-        return conn
+        return connect_args, role_credentials
+
+    def assume_role(self, region, connect_args):
+        ''' Assumes iam_role, reusing the credentials of an earlier call until
+        shortly before they expire '''
+
+        key = (self.boto_profile, self.iam_role)
+        # Hold the lock while calling STS so concurrent shards share one role
+        with self.connection_lock:
+            role_credentials = self.role_credentials.get(key)
+            if role_credentials is None or self.role_credentials_expiring(role_credentials):
+                sts_conn = sts.connect_to_region(region, **connect_args)
+                role = self.call_api('sts', sts_conn.assume_role, self.iam_role, 'ansible_dynamic_inventory')
+                role_credentials = self.role_credentials[key] = role.credentials
+                self.count('sts.assume_role')
+        return role_credentials
+
+    def role_credentials_expiring(self, role_credentials):
+        ''' Tells if assumed role credentials expire within five minutes '''
+
+        return role_credentials is not None and role_credentials.is_expired(time_offset_seconds=300)
 
     def get_instances_by_region(self, region):
         ''' Makes an AWS EC2 API call to the list of instances in a particular
@@ -578,41 +1514,66 @@ class Ec2Inventory(object):
         try:
             conn = self.connect(region)
             reservations = []
-            if self.ec2_instance_filters:
-                if self.stack_filters:
-                    filters_dict = {}
-                    for filter_key, filter_values in self.ec2_instance_filters.items():
-                        filters_dict[filter_key] = filter_values
-                    reservations.extend(conn.get_all_instances(filters=filters_dict))
+            for filters in self.plan_instance_filters():
+                if filters:
+                    plan_reservations = self.call_api('ec2', conn.get_all_instances, filters=filters)
                 else:
-                    for filter_key, filter_values in self.ec2_instance_filters.items():
-                        reservations.extend(conn.get_all_instances(filters={filter_key: filter_values}))
-            else:
-                reservations = conn.get_all_instances()
+                    plan_reservations = self.call_api('ec2', conn.get_all_instances)
+                reservations.extend(plan_reservations)
+                self.count('ec2.get_all_instances.calls')
+                self.count('ec2.get_all_instances.instances',
+                           sum(len(reservation.instances) for reservation in plan_reservations))
+
+            # Filters that are not stacked can return the same instance more
+            # than once, keep the first one
+            instances = []
+            instance_ids = []
+            seen_instance_ids = set()
+            for reservation in reservations:
+                for instance in reservation.instances:
+                    if instance.id in seen_instance_ids:
+                        self.count('ec2.get_all_instances.duplicates')
+                        continue
+                    seen_instance_ids.add(instance.id)
+                    instances.append(instance)
+                    instance_ids.append(instance.id)
 
             # Pull the tags back in a second step
             # AWS are on record as saying that the tags fetched in the first `get_all_instances` request are not
             # reliable and may be missing, and the only way to guarantee they are there is by calling `get_all_tags`
-            instance_ids = []
-            for reservation in reservations:
-                instance_ids.extend([instance.id for instance in reservation.instances])
+            # (unless tag_fetch_strategy says otherwise)
+            tag_fetch_start = time()
+            if self.tag_fetch_strategy == 'sweep':
+                swept_instance_ids = instance_ids
+            elif self.tag_fetch_strategy == 'verify':
+                swept_instance_ids = [instance.id for instance in instances if not instance.tags]
+            else:
+                swept_instance_ids = []
+
+            def get_tags(chunk):
+                return self.call_api('ec2', conn.get_all_tags, filters={'resource-type': 'instance', 'resource-id': chunk})
 
             max_filter_value = 199
-            tags = []
-            for i in range(0, len(instance_ids), max_filter_value):
-                tags.extend(conn.get_all_tags(filters={'resource-type': 'instance', 'resource-id': instance_ids[i:i + max_filter_value]}))
+            chunks = [swept_instance_ids[i:i + max_filter_value]
+                      for i in range(0, len(swept_instance_ids), max_filter_value)]
 
             tags_by_instance_id = defaultdict(dict)
-            for tag in tags:
-                tags_by_instance_id[tag.res_id][tag.name] = tag.value
+            for tags in self.map_concurrently(get_tags, chunks):
+                self.count('ec2.get_all_tags.tags', len(tags))
+                for tag in tags:
+                    tags_by_instance_id[tag.res_id][tag.name] = tag.value
+
+            self.count('ec2.get_all_tags.calls', len(chunks))
+            self.count('ec2.tag_fetch.%s.seconds' % self.tag_fetch_strategy, time() - tag_fetch_start)
+            swept_instance_ids = set(swept_instance_ids)
 
             if (not self.aws_account_id) and reservations:
                 self.aws_account_id = reservations[0].owner_id
 
-            for reservation in reservations:
-                for instance in reservation.instances:
+            for instance in instances:
+                if instance.id in swept_instance_ids:
                     instance.tags = tags_by_instance_id[instance.id]
-                    self.add_instance(instance, region)
+                self.add_instance(instance, region)
 
         except boto.exception.BotoServerError as e:
             if e.error_code == 'AuthFailure':
@@ -622,6 +1583,28 @@ class Ec2Inventory(object):
                 error = "Error connecting to %s backend.\n%s" % (backend, e.message)
             self.fail_with_error(error, 'getting EC2 instances')
 
+    def plan_instance_filters(self):
+        ''' Works out the filters of the get_all_instances calls that fetch
+        the instances of a region, as one dict per call '''
+
+        if not self.ec2_instance_filters:
+            plans = [{}]
+        elif self.stack_filters:
+            plans = [dict(self.ec2_instance_filters)]
+        else:
+            # Filters on different keys are ORed together, which a single
+            # call can't express (the API ANDs them), so each key needs its
+            # own call. Values of the same key are already merged.
+            plans = [{filter_key: filter_values} for filter_key, filter_values in self.ec2_instance_filters.items()]
+
+        # add_instance skips instances in other states anyway, so let AWS
+        # leave them out unless a filter already selects states
+        if not self.all_instances and not self.eucalyptus:
+            for filters in plans:
+                filters.setdefault('instance-state-name', self.ec2_instance_states)
+
+        return plans
+
     def get_rds_instances_by_region(self, region):
         ''' Makes an AWS API call to the list of RDS instances in a particular
         region '''
@@ -630,20 +1613,25 @@ class Ec2Inventory(object):
             self.fail_with_error("Working with RDS instances requires boto3 - please install boto3 and try again",
                                  "getting RDS instances")
 
-        client = ec2_utils.boto3_inventory_conn('client', 'rds', region, **self.credentials)
-        db_instances = client.describe_db_instances()
-
         try:
             conn = self.connect_to_aws(rds, region)
+            client = self.connect_to_boto3('rds', region)
+            account_id = self.get_account_id(region)
+
+            def get_tags(instance):
+                return self.call_api('rds', client.list_tags_for_resource, ResourceName=instance.arn)['TagList']
+
             if conn:
                 marker = None
                 while True:
-                    instances = conn.get_all_dbinstances(marker=marker)
+                    instances = self.call_api('rds', conn.get_all_dbinstances, marker=marker)
+                    self.count('rds.get_all_dbinstances.instances', len(instances))
                     marker = instances.marker
-                    for index, instance in enumerate(instances):
-                        # Add tags to instances.
-                        instance.arn = db_instances['DBInstances'][index]['DBInstanceArn']
-                        tags = client.list_tags_for_resource(ResourceName=instance.arn)['TagList']
+                    for instance in instances:
+                        instance.arn = self.get_rds_arn(region, account_id, 'db', instance.id)
+
+                    # Add tags to instances, looking them up concurrently
+                    for instance, tags in zip(instances, self.map_concurrently(get_tags, instances)):
                         instance.tags = {}
                         for tag in tags:
                             instance.tags[tag['Key']] = tag['Value']
@@ -664,22 +1652,60 @@ class Ec2Inventory(object):
                 error = "Looks like AWS RDS is down:\n%s" % e.message
             self.fail_with_error(error, 'getting RDS instances')
 
+    def get_account_id(self, region):
+        ''' Returns the ID of the AWS account the credentials belong to,
+        looking it up only once per run '''
+
+        key = (self.boto_profile, self.iam_role)
+        with self.connection_lock:
+            if key not in self.account_ids:
+                identity = self.call_api('sts', self.connect_to_boto3('sts', region).get_caller_identity)
+                self.account_ids[key] = identity['Account']
+        return self.account_ids[key]
+
+    def get_rds_arn(self, region, account_id, resource_type, name):
+        ''' Builds the ARN of an RDS resource '''
+
+        # arn:<partition>:rds:<region>:<account number>:<resourcetype>:<name>
+        if region.startswith('cn-'):
+            partition = 'aws-cn'
+        elif region.startswith('us-gov-'):
+            partition = 'aws-us-gov'
+        else:
+            partition = 'aws'
+        return ':'.join(['arn', partition, 'rds', region, account_id, resource_type, name])
+
     def include_rds_clusters_by_region(self, region):
         if not HAS_BOTO3:
             self.fail_with_error("Working with RDS clusters requires boto3 - please install boto3 and try again",
                                  "getting RDS clusters")
 
-        client = ec2_utils.boto3_inventory_conn('client', 'rds', region, **self.credentials)
+        client = self.connect_to_boto3('rds', region)
 
         marker, clusters = '', []
         while marker is not None:
-            resp = client.describe_db_clusters(Marker=marker)
+            resp = self.call_api('rds', client.describe_db_clusters, Marker=marker)
             clusters.extend(resp["DBClusters"])
             marker = resp.get('Marker', None)
 
-        account_id = boto.connect_iam().get_user().arn.split(':')[4]
+        # ignore empty clusters caused by AWS bug (2016-01-06): deletion does
+        # not fully complete and leaves an 'empty' cluster behind
+        clusters = [c for c in clusters if len(c['DBClusterMembers']) > 0]
+
+        account_id = self.get_account_id(region)
+
+        def get_tags(c):
+            try:
+                return self.call_api(
+                    'rds', client.list_tags_for_resource,
+                    ResourceName=self.get_rds_arn(region, account_id, 'cluster', c['DBClusterIdentifier']))['TagList']
+            except Exception:
+                # Ignore errors when trying to find tags, e.g. DBInstanceNotFound
+                # for clusters deleted in the meantime
+                return None
+
         c_dict = {}
-        for c in clusters:
+        for c, tags in zip(clusters, self.map_concurrently(get_tags, clusters)):
             # remove these datetime objects as there is no serialisation to json
             # currently in place and we don't need the data yet
             if 'EarliestRestorableTime' in c:
@@ -692,11 +1718,8 @@ class Ec2Inventory(object):
             else:
                 matches_filter = False
 
-            try:
-                # arn:aws:rds:<region>:<account number>:<resourcetype>:<name>
-                tags = client.list_tags_for_resource(
-                    ResourceName='arn:aws:rds:' + region + ':' + account_id + ':cluster:' + c['DBClusterIdentifier'])
-                c['Tags'] = tags['TagList']
+            if tags is not None:
+                c['Tags'] = tags
 
                 if self.ec2_instance_filters:
                     for filter_key, filter_values in self.ec2_instance_filters.items():
@@ -709,93 +1732,117 @@ class Ec2Inventory(object):
                             # it matches a filter, so stop looking for further matches
                             break
 
-            except Exception as e:
-                if e.message.find('DBInstanceNotFound') >= 0:
-                    # AWS RDS bug (2016-01-06) means deletion does not fully complete and leave an 'empty' cluster.
-                    # Ignore errors when trying to find tags for these
-                    pass
-
-            # ignore empty clusters caused by AWS bug
-            if len(c['DBClusterMembers']) == 0:
-                continue
-            elif matches_filter:
+            if matches_filter:
                 c_dict[c['DBClusterIdentifier']] = c
 
         self.inventory['db_clusters'] = c_dict
 
-    def get_elasticache_clusters_by_region(self, region):
-        ''' Makes an AWS API call to the list of ElastiCache clusters (with
-        nodes' info) in a particular region.'''
+    def get_elasticache_by_region(self, region):
+        ''' Adds the ElastiCache clusters and replication groups of a region.
+        The replication groups are fetched in the background while the
+        clusters are added page by page, and are added after them. '''
+
+        stop = threading.Event()
+        replication_group_pages = self.prefetch(self.get_elasticache_replication_group_pages(region), stop)
+
+        try:
+            for clusters in self.get_elasticache_cluster_pages(region):
+                for cluster in clusters:
+                    self.add_elasticache_cluster(cluster, region)
+
+            for replication_groups in replication_group_pages:
+                for replication_group in replication_groups:
+                    self.add_elasticache_replication_group(replication_group, region)
+        finally:
+            stop.set()
+
+    def get_elasticache_cluster_pages(self, region):
+        ''' Makes paginated AWS API calls to list the ElastiCache clusters
+        (with nodes' info) in a particular region, yielding each page of
+        clusters as it arrives '''
 
         # ElastiCache boto module doesn't provide a get_all_instances method,
         # that's why we need to call describe directly (it would be called by
         # the shorthand method anyway...)
-        try:
-            conn = self.connect_to_aws(elasticache, region)
-            if conn:
+        marker = None
+        while True:
+            try:
+                conn = self.connect_to_aws(elasticache, region)
                 # show_cache_node_info = True
                 # because we also want nodes' information
-                response = conn.describe_cache_clusters(None, None, None, True)
+                response = self.call_api('elasticache', conn.describe_cache_clusters, None, None, marker, True)
 
-        except boto.exception.BotoServerError as e:
-            error = e.reason
+            except boto.exception.BotoServerError as e:
+                error = e.reason
 
-            if e.error_code == 'AuthFailure':
-                error = self.get_auth_error_message()
-            elif e.error_code == "OptInRequired":
-                error = "ElastiCache hasn't been enabled for this account yet. " \
-                    "You must either log in to the ElastiCache service through the AWS console to enable it, " \
-                    "or set 'elasticache = False' in ec2.ini"
-            elif not e.reason == "Forbidden":
-                error = "Looks like AWS ElastiCache is down:\n%s" % e.message
-            self.fail_with_error(error, 'getting ElastiCache clusters')
+                if e.error_code == 'AuthFailure':
+                    error = self.get_auth_error_message()
+                elif e.error_code == "OptInRequired":
+                    error = "ElastiCache hasn't been enabled for this account yet. " \
+                        "You must either log in to the ElastiCache service through the AWS console to enable it, " \
+                        "or set 'elasticache = False' in ec2.ini"
+                elif not e.reason == "Forbidden":
+                    error = "Looks like AWS ElastiCache is down:\n%s" % e.message
+                self.fail_with_error(error, 'getting ElastiCache clusters')
 
-        try:
-            # Boto also doesn't provide wrapper classes to CacheClusters or
-            # CacheNodes. Because of that we can't make use of the get_list
-            # method in the AWSQueryConnection. Let's do the work manually
-            clusters = response['DescribeCacheClustersResponse']['DescribeCacheClustersResult']['CacheClusters']
+            try:
+                # Boto also doesn't provide wrapper classes to CacheClusters or
+                # CacheNodes. Because of that we can't make use of the get_list
+                # method in the AWSQueryConnection. Let's do the work manually
+                result = response['DescribeCacheClustersResponse']['DescribeCacheClustersResult']
+                clusters = result['CacheClusters']
+
+            except KeyError as e:
+                error = "ElastiCache query to AWS failed (unexpected format)."
+                self.fail_with_error(error, 'getting ElastiCache clusters')
 
-        except KeyError as e:
-            error = "ElastiCache query to AWS failed (unexpected format)."
-            self.fail_with_error(error, 'getting ElastiCache clusters')
+            self.count('elasticache.describe_cache_clusters.pages')
+            yield clusters
 
-        for cluster in clusters:
-            self.add_elasticache_cluster(cluster, region)
+            marker = result.get('Marker')
+            if not marker:
+                break
 
-    def get_elasticache_replication_groups_by_region(self, region):
-        ''' Makes an AWS API call to the list of ElastiCache replication groups
-        in a particular region.'''
+    def get_elasticache_replication_group_pages(self, region):
+        ''' Makes paginated AWS API calls to list the ElastiCache replication
+        groups in a particular region, yielding each page of replication
+        groups as it arrives '''
 
         # ElastiCache boto module doesn't provide a get_all_instances method,
         # that's why we need to call describe directly (it would be called by
         # the shorthand method anyway...)
-        try:
-            conn = self.connect_to_aws(elasticache, region)
-            if conn:
-                response = conn.describe_replication_groups()
+        marker = None
+        while True:
+            try:
+                conn = self.connect_to_aws(elasticache, region)
+                response = self.call_api('elasticache', conn.describe_replication_groups, None, None, marker)
 
-        except boto.exception.BotoServerError as e:
-            error = e.reason
+            except boto.exception.BotoServerError as e:
+                error = e.reason
 
-            if e.error_code == 'AuthFailure':
-                error = self.get_auth_error_message()
-            if not e.reason == "Forbidden":
-                error = "Looks like AWS ElastiCache [Replication Groups] is down:\n%s" % e.message
-            self.fail_with_error(error, 'getting ElastiCache clusters')
+                if e.error_code == 'AuthFailure':
+                    error = self.get_auth_error_message()
+                if not e.reason == "Forbidden":
+                    error = "Looks like AWS ElastiCache [Replication Groups] is down:\n%s" % e.message
+                self.fail_with_error(error, 'getting ElastiCache clusters')
 
-        try:
-            # Boto also doesn't provide wrapper classes to ReplicationGroups
-            # Because of that we can't make use of the get_list method in the
-            # AWSQueryConnection. Let's do the work manually
-            replication_groups = response['DescribeReplicationGroupsResponse']['DescribeReplicationGroupsResult']['ReplicationGroups']
+            try:
+                # Boto also doesn't provide wrapper classes to ReplicationGroups
+                # Because of that we can't make use of the get_list method in the
+                # AWSQueryConnection. Let's do the work manually
+                result = response['DescribeReplicationGroupsResponse']['DescribeReplicationGroupsResult']
+                replication_groups = result['ReplicationGroups']
 
-        except KeyError as e:
-            error = "ElastiCache [Replication Groups] query to AWS failed (unexpected format)."
-            self.fail_with_error(error, 'getting ElastiCache clusters')
+            except KeyError as e:
+                error = "ElastiCache [Replication Groups] query to AWS failed (unexpected format)."
+                self.fail_with_error(error, 'getting ElastiCache clusters')
 
-        for replication_group in replication_groups:
-            self.add_elasticache_replication_group(replication_group, region)
+            self.count('elasticache.describe_replication_groups.pages')
+            yield replication_groups
+
+            marker = result.get('Marker')
+            if not marker:
+                break
 
     def get_auth_error_message(self):
         ''' create an informative error message if there is an issue authenticating'''
@@ -814,18 +1861,44 @@ class Ec2Inventory(object):
 
         return '\n'.join(errors)
 
+    @contextlib.contextmanager
+    def timed(self, name):
+        ''' Counts the seconds spent in a block as <name>.seconds '''
+
+        start = time()
+        try:
+            yield
+        finally:
+            self.count(name + '.seconds', time() - start)
+
+    def count(self, name, value=1):
+        ''' Adds to one of the counters reported with --stats '''
+
+        with self.stats_lock:
+            self.stats[name] += value
+
+    def write_stats(self):
+        ''' Writes the --stats counters as JSON to stderr, and to stats_file
+        if it is set '''
+
+        if self.args.stats:
+            sys.stderr.write(self.json_format_dict(self.stats, True) + '\n')
+        if self.stats_file:
+            self.write_to_cache(self.stats, self.stats_file)
+
     def fail_with_error(self, err_msg, err_operation=None):
         '''log an error to std err for ansible-playbook to consume and exit'''
         if err_operation:
             err_msg = 'ERROR: "{err_msg}", while: {err_operation}'.format(
                 err_msg=err_msg, err_operation=err_operation)
         sys.stderr.write(err_msg)
-        sys.exit(1)
+        raise InventoryError(err_msg)
 
     def get_instance(self, region, instance_id):
+        self.prepare_api_calls()
         conn = self.connect(region)
 
-        reservations = conn.get_all_instances([instance_id])
+        reservations = self.call_api('ec2', conn.get_all_instances, [instance_id])
         for reservation in reservations:
             for instance in reservation.instances:
                 return instance
@@ -1345,30 +2418,66 @@ class Ec2Inventory(object):
             r53_conn = route53.Route53Connection(profile_name=self.boto_profile)
         else:
             r53_conn = route53.Route53Connection()
-        all_zones = r53_conn.get_zones()
+        all_zones = self.call_api('route53', r53_conn.get_zones)
 
         route53_zones = [zone for zone in all_zones if zone.name[:-1] not in self.route53_excluded_zones]
 
-        self.route53_records = {}
+        cached_zones = {}
+        if self.route53_zone_cache and os.path.isfile(self.cache_path_route53):
+            with open(self.cache_path_route53, 'r') as f:
+                cached_zones = json.load(f)
 
+        zones = {}
         for zone in route53_zones:
-            rrsets = r53_conn.get_all_rrsets(zone.id)
+            # boto stores the zone's ResourceRecordSetCount under this name
+            record_count = getattr(zone, 'resourcerecordsetcount', None)
+            cached_zone = cached_zones.get(zone.id)
+            if cached_zone and record_count is not None and cached_zone['record_count'] == record_count \
+                    and time() - cached_zone.get('listed', 0) < self.route53_zone_cache_max_age:
+                zones[zone.id] = cached_zone
+                self.count('route53.zones.cached')
+                continue
 
-            for record_set in rrsets:
+            records = {}
+            for record_set in self.call_api('route53', r53_conn.get_all_rrsets, zone.id):
+                self.count('route53.get_all_rrsets.records')
                 record_name = record_set.name
 
                 if record_name.endswith('.'):
                     record_name = record_name[:-1]
 
                 for resource in record_set.resource_records:
-                    self.route53_records.setdefault(resource, set())
-                    self.route53_records[resource].add(record_name)
+                    records.setdefault(resource, set())
+                    records[resource].add(record_name)
+
+            zones[zone.id] = {
+                'record_count': record_count,
+                'listed': int(time()),
+                'records': dict((resource, sorted(names)) for resource, names in records.items()),
+            }
+            self.count('route53.zones.listed')
+
+        if self.route53_zone_cache:
+            self.write_to_cache(zones, self.cache_path_route53)
+
+        # Index every resource record value to the names pointing to it
+        self.route53_records = {}
+        self.route53_names_by_instance = {}
+        for zone in route53_zones:
+            for resource, names in zones[zone.id]['records'].items():
+                self.route53_records.setdefault(resource, set())
+                self.route53_records[resource].update(names)
 
     def get_instance_route53_names(self, instance):
         ''' Check if an instance is referenced in the records we have from
         Route53. If it is, return the list of domain names pointing to said
         instance. If nothing points to it, return an empty list. '''
 
+        # add_instance asks twice per instance, once for the hostname and
+        # once for the groups
+        if instance.id in self.route53_names_by_instance:
+            return self.route53_names_by_instance[instance.id]
+
         instance_attributes = ['public_dns_name', 'private_dns_name',
                                'ip_address', 'private_ip_address']
 
@@ -1383,13 +2492,20 @@ class Ec2Inventory(object):
             if value in self.route53_records:
                 name_list.update(self.route53_records[value])
 
-        return list(name_list)
+        name_list = self.route53_names_by_instance[instance.id] = sorted(name_list)
+        return name_list
 
     def get_host_info_dict_from_instance(self, instance):
         instance_vars = {}
-        for key in vars(instance):
-            value = getattr(instance, key)
-            key = self.to_safe('ec2_' + key)
+        for attribute in vars(instance):
+            key = self.to_safe('ec2_' + attribute)
+
+            # Don't even read attributes none of whose variables are wanted
+            if self.hostvars_projected and key != 'ec2_tags':
+                if not any(self.is_hostvar_wanted(name) for name in HOSTVARS_BY_ATTRIBUTE.get(key, [key])):
+                    continue
+
+            value = getattr(instance, attribute)
 
             # Handle complex types
             # state/previous_state changed to properties in boto in https://github.com/boto/boto/commit/a23c379837f698212252720d2af8dec0325c9518
@@ -1436,7 +2552,9 @@ class Ec2Inventory(object):
 
         instance_vars[self.to_safe('ec2_account_id')] = self.aws_account_id
 
-        return instance_vars
+        if self.hostvars_projected:
+            self.project_host_vars(instance_vars)
+        return self.share_values(instance_vars)
 
     def get_host_info_dict_from_describe_dict(self, describe_dict):
         ''' Parses the dictionary returned by the API call into a flat list
@@ -1521,26 +2639,117 @@ class Ec2Inventory(object):
                 # Remove non-processed complex types
                 pass
 
-        return host_info
+        if self.hostvars_projected:
+            self.project_host_vars(host_info)
+        return self.share_values(host_info)
+
+    def is_hostvar_wanted(self, name):
+        ''' Determines if a host variable passes hostvars_include and
+        hostvars_exclude '''
+
+        try:
+            return self.hostvar_wanted_memo[name]
+        except KeyError:
+            pass
+
+        wanted = (not self.hostvars_include or any(fnmatch.fnmatchcase(name, pattern) for pattern in self.hostvars_include)) \
+            and not any(fnmatch.fnmatchcase(name, pattern) for pattern in self.hostvars_exclude)
+        self.remember(self.hostvar_wanted_memo, name, wanted)
+        return wanted
+
+    def project_host_vars(self, host_vars):
+        ''' Drops the variables of a host that are not wanted, in place '''
+
+        for name in [name for name in host_vars if not self.is_hostvar_wanted(name)]:
+            del host_vars[name]
+
+    def share_values(self, host_vars):
+        ''' Replaces the string values of a host's variables with the copy of
+        each kept in self.shared_values, so repeated values are stored once '''
+
+        shared_values = self.shared_values
+        for key, value in host_vars.items():
+            if isinstance(value, six.string_types):
+                host_vars[key] = shared_values.setdefault(value, value)
+        return host_vars
+
+    def encode_shared_values(self, inventory):
+        ''' Returns a copy of the inventory for the 'shared' cache encoding:
+        _meta.shared_values lists every distinct host variable name and
+        value once, and each host is a flat list of the positions of its
+        names and values in it '''
+
+        shared_values = []
+        positions = {}
+
+        def position(value):
+            # The type is part of the key so that 1 and True stay apart, and
+            # lists and dicts are compared by their JSON form
+            if isinstance(value, (list, dict)):
+                key = JSON_COMPACT_ENCODER.encode(value)
+            else:
+                key = (type(value), value)
+            if key not in positions:
+                positions[key] = len(shared_values)
+                shared_values.append(value)
+            return positions[key]
+
+        hostvars = {}
+        for hostname, host_vars in inventory['_meta']['hostvars'].items():
+            hostvars[hostname] = [position(item) for key_value in host_vars.items() for item in key_value]
+
+        encoded_inventory = dict(inventory)
+        encoded_inventory['_meta'] = dict(inventory['_meta'], hostvars=hostvars, shared_values=shared_values)
+        return encoded_inventory
+
+    def decode_shared_values(self, inventory):
+        ''' Turns an inventory written with the 'shared' cache encoding back
+        into a plain one, in place '''
+
+        meta = inventory['_meta']
+        shared_values = meta.pop('shared_values')
+        for hostname, positions in meta['hostvars'].items():
+            meta['hostvars'][hostname] = self.decode_host_vars(positions, shared_values)
+        return inventory
+
+    def decode_host_vars(self, positions, shared_values):
+        ''' Returns the variables of a host from its positions in
+        _meta.shared_values '''
+
+        values = [shared_values[i] for i in positions]
+        return dict(zip(values[0::2], values[1::2]))
 
     def get_host_info(self):
         ''' Get variables about a specific host '''
 
+        # Serve the variables gathered by the last refresh, and only ask AWS
+        # when the host is not known or a live lookup was requested
+        if not self.args.live:
+            host_vars = self.get_host_vars_from_cache(self.args.host)
+            if host_vars is not None:
+                return self.json_format_dict(host_vars, not self.json_compact)
+
         if len(self.index) == 0:
             # Need to load index from cache
             self.load_index_from_cache()
 
-        if self.args.host not in self.index:
-            # try updating the cache
-            self.do_api_calls_update_cache()
-            if self.args.host not in self.index:
-                # host might not exist anymore
-                return self.json_format_dict({}, True)
-
-        (region, instance_id) = self.index[self.args.host]
-
-        instance = self.get_instance(region, instance_id)
-        return self.json_format_dict(self.get_host_info_dict_from_instance(instance), True)
+        # Only EC2 instances can be looked up on their own. The index holds
+        # the DB and cluster IDs of RDS and ElastiCache hosts.
+        if self.args.host in self.index:
+            (region, instance_id) = self.index[self.args.host]
+            if instance_id.startswith('i-'):
+                instance = self.get_instance(region, instance_id)
+                if instance is None:
+                    # terminated since the cache was written
+                    return self.json_format_dict({}, not self.json_compact)
+                return self.json_format_dict(self.get_host_info_dict_from_instance(instance), not self.json_compact)
+
+        # Otherwise refresh the cache, shards included, as the host may have
+        # been launched since they were written. The refresh gathers the
+        # variables of every host, so they are served from memory.
+        self.do_api_calls_update_cache(force=True)
+        host_vars = self.inventory['_meta']['hostvars'].get(self.args.host, {})
+        return self.json_format_dict(host_vars, not self.json_compact)
 
     def push(self, my_dict, key, element):
         ''' Push an element onto an array that may not have been defined in
@@ -1557,41 +2766,489 @@ class Ec2Inventory(object):
         parent_group = my_dict.setdefault(key, {})
         if not isinstance(parent_group, dict):
             parent_group = my_dict[key] = {'hosts': parent_group}
-        child_groups = parent_group.setdefault('children', [])
+        child_groups = parent_group.get('children')
+        if child_groups is None:
+            child_groups = parent_group['children'] = ChildGroups()
         if element not in child_groups:
             child_groups.append(element)
 
-    def get_inventory_from_cache(self):
-        ''' Reads the inventory from the cache file and returns it as a JSON
-        object '''
+    def write_inventory_from_cache(self, stream):
+        ''' Copies the JSON inventory from the cache to a file object '''
+
+        if self.cache_backend == 'sqlite':
+            with self.connect_to_sqlite_cache() as db:
+                stream.write(db.execute('SELECT data FROM inventory').fetchone()[0])
+            return
+
+        with open(self.cache_path_cache, 'r') as f:
+            if self.cache_encoding == 'shared':
+                self.write_json(self.decode_shared_values(json.load(f)), stream)
+            else:
+                shutil.copyfileobj(f, stream)
+
+    def load_inventory_from_cache(self):
+        ''' Reads the whole inventory from the cache '''
+
+        if self.cache_backend == 'sqlite':
+            with self.connect_to_sqlite_cache() as db:
+                return json.loads(db.execute('SELECT data FROM inventory').fetchone()[0])
+
+        with open(self.cache_path_cache, 'r') as f:
+            inventory = json.load(f)
+        if self.cache_encoding == 'shared':
+            inventory = self.decode_shared_values(inventory)
+        return inventory
+
+    def get_changes(self, previous, current):
+        ''' Compares two inventories. Returns the hosts added (with their
+        variables), the hosts removed, the variables changed or removed on
+        the other hosts, and the hosts that joined or left each group. '''
+
+        previous_hostvars = previous['_meta']['hostvars']
+        current_hostvars = current['_meta']['hostvars']
+        changes = {
+            'refreshed': int(time()),
+            'added': {},
+            'removed': sorted(hostname for hostname in previous_hostvars if hostname not in current_hostvars),
+            'modified': {},
+            'groups': {},
+        }
+
+        for hostname, host_vars in current_hostvars.items():
+            previous_vars = previous_hostvars.get(hostname)
+            if previous_vars is None:
+                changes['added'][hostname] = host_vars
+            elif previous_vars != host_vars:
+                changes['modified'][hostname] = {
+                    'changed': dict((key, value) for key, value in host_vars.items()
+                                    if key not in previous_vars or previous_vars[key] != value),
+                    'removed': sorted(key for key in previous_vars if key not in host_vars),
+                }
+
+        previous_groups = self.get_group_hosts(previous)
+        current_groups = self.get_group_hosts(current)
+        for group in set(previous_groups) | set(current_groups):
+            previous_hosts = previous_groups.get(group, set())
+            current_hosts = current_groups.get(group, set())
+            if previous_hosts != current_hosts:
+                changes['groups'][group] = {
+                    'added': sorted(current_hosts - previous_hosts),
+                    'removed': sorted(previous_hosts - current_hosts),
+                }
+
+        # Hosts of regions or services that could not be fetched may show as
+        # removed
+        if 'stale_shards' in current['_meta']:
+            changes['stale_shards'] = current['_meta']['stale_shards']
+
+        return changes
+
+    def get_group_hosts(self, inventory):
+        ''' Returns the set of hosts of every group of an inventory '''
+
+        group_hosts = {}
+        for group, value in inventory.items():
+            if group == '_meta':
+                continue
+            if isinstance(value, dict):
+                value = value.get('hosts', [])
+            group_hosts[group] = set(value)
+        return group_hosts
+
+    def get_changes_from_cache(self):
+        ''' Returns the changes written by the last refresh '''
+
+        if not os.path.isfile(self.cache_path_changes):
+            self.fail_with_error("No changes recorded yet: set change_feed = True in ec2.ini or run with "
+                                 "--changes --refresh-cache", 'reading the changes')
+
+        with open(self.cache_path_changes, 'r') as f:
+            return f.read()
+
+    def get_groups(self, inventory):
+        ''' Returns the groups of an inventory, without the host variables '''
+
+        return dict((group, value) for group, value in inventory.items() if group != '_meta')
+
+    def get_inventory_of_groups(self, patterns):
+        ''' Returns the part of the inventory --list --group prints: the
+        groups matching any of the patterns, their child groups, and the
+        variables of their hosts. Only the group index and the variables of
+        those hosts are read from the cache. '''
+
+        # Patterns match as given, or sanitized like group names (so
+        # tag_Name=web matches tag_Name_web)
+        patterns = patterns + [''.join(part if GLOB_CHARS_RE.match(part) else self.to_safe(part)
+                                       for part in GLOB_CHARS_RE.split(pattern)) for pattern in patterns]
+
+        if self.inventory['_meta']['hostvars']:
+            groups = self.get_groups(self.inventory)
+        else:
+            groups = self.load_groups_from_cache()
+
+        inventory = {}
+        pending = [group for group in groups if any(fnmatch.fnmatchcase(group, pattern) for pattern in patterns)]
+        while pending:
+            group = pending.pop()
+            if group in inventory or group not in groups:
+                continue
+            inventory[group] = groups[group]
+            if isinstance(groups[group], dict):
+                pending.extend(groups[group].get('children', []))
+
+        hostnames = set()
+        for value in inventory.values():
+            hostnames.update(value.get('hosts', []) if isinstance(value, dict) else value)
+        inventory['_meta'] = {'hostvars': self.get_hosts_vars_from_cache(hostnames)}
+        return inventory
+
+    def load_groups_from_cache(self):
+        ''' Reads the groups of the inventory from the cache, falling back
+        to the whole inventory for caches written without a group index '''
+
+        if self.cache_backend == 'sqlite':
+            try:
+                with self.connect_to_sqlite_cache() as db:
+                    return json.loads(db.execute('SELECT data FROM groups').fetchone()[0])
+            except sqlite3.OperationalError:
+                pass
+        elif os.path.isfile(self.cache_path_groups):
+            with open(self.cache_path_groups, 'r') as f:
+                return json.load(f)
+
+        return self.get_groups(self.load_inventory_from_cache())
+
+    def get_hosts_vars_from_cache(self, hostnames):
+        ''' Returns the variables of several hosts as gathered by the last
+        refresh, by hostname, from memory if the inventory was just built or
+        else from the cache. Unknown hosts are left out. '''
+
+        if self.inventory['_meta']['hostvars']:
+            hostvars = self.inventory['_meta']['hostvars']
+            return dict((hostname, hostvars[hostname]) for hostname in hostnames if hostname in hostvars)
+
+        if self.cache_backend == 'sqlite':
+            if not os.path.isfile(self.cache_path_db):
+                return {}
+            with self.connect_to_sqlite_cache() as db:
+                rows = [db.execute('SELECT hostname, data FROM hostvars WHERE hostname = ?', (hostname,)).fetchone()
+                        for hostname in hostnames]
+            return dict((row[0], json.loads(row[1])) for row in rows if row)
+
+        if not os.path.isfile(self.cache_path_cache):
+            return {}
+
+        hosts_vars = self.load_hosts_vars_from_cache(hostnames)
+        if hosts_vars is not None:
+            return hosts_vars
 
+        # Caches written without the host variables file
         with open(self.cache_path_cache, 'r') as f:
-            json_inventory = f.read()
-            return json_inventory
+            inventory = json.load(f)
+        hostvars = inventory['_meta']['hostvars']
+        if self.cache_encoding == 'shared':
+            shared_values = inventory['_meta']['shared_values']
+            return dict((hostname, self.decode_host_vars(hostvars[hostname], shared_values))
+                        for hostname in hostnames if hostname in hostvars)
+        return dict((hostname, hostvars[hostname]) for hostname in hostnames if hostname in hostvars)
+
+    def load_hosts_vars_from_cache(self, hostnames):
+        ''' Reads the variables of several hosts from the host variables
+        file, seeking to each host's line. Returns None when the file or its
+        index is missing, or when they don't match each other. '''
+
+        try:
+            with open(self.cache_path_hostvars_index, 'r') as f:
+                offsets = json.load(f)
+
+            hosts_vars = {}
+            with open(self.cache_path_hostvars, 'rb') as f:
+                for hostname in sorted((hostname for hostname in hostnames if hostname in offsets),
+                                       key=offsets.get):
+                    offset, length = offsets[hostname]
+                    f.seek(offset)
+                    line_hostname, host_vars = json.loads(f.read(length).decode('utf-8'))
+                    # The index of another refresh
+                    if line_hostname != hostname:
+                        return None
+                    hosts_vars[hostname] = host_vars
+            return hosts_vars
+        except (IOError, OSError, ValueError):
+            return None
+
+    def get_host_vars_from_cache(self, hostname):
+        ''' Returns the variables of a host as gathered by the last refresh.
+        Returns None for unknown hosts. '''
+
+        return self.get_hosts_vars_from_cache([hostname]).get(hostname)
+
+    def run_daemon(self):
+        ''' Keeps the inventory in memory and answers --list and --host over
+        a Unix socket until interrupted. The inventory is refreshed in the
+        background whenever the cache expires. '''
+
+        if self.request_from_daemon() is not None:
+            self.fail_with_error("An inventory daemon is already listening on %s" % self.daemon_socket)
+
+        delay = self.cache_merged_max_age
+        if self.is_cache_valid():
+            self.load_daemon_state_from_cache()
+            delay -= self.get_cache_age()
+        else:
+            self.refresh_daemon_state()
+
+        refresher = threading.Thread(target=self.refresh_daemon_periodically, args=(delay,))
+        refresher.daemon = True
+        refresher.start()
+
+        # A socket left behind by a daemon that was killed would make bind fail
+        if os.path.exists(self.daemon_socket):
+            os.remove(self.daemon_socket)
+        old_umask = os.umask(0o077)
+        try:
+            server = InventoryServer(self.daemon_socket, self)
+        finally:
+            os.umask(old_umask)
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(self.daemon_socket)
+
+    def refresh_daemon_periodically(self, delay):
+        ''' Refreshes the daemon inventory whenever the cache expires,
+        starting after delay seconds '''
+
+        while True:
+            sleep(max(delay, 1))
+            delay = self.cache_merged_max_age
+            try:
+                self.refresh_daemon_state()
+            except SystemExit:
+                # fail_with_error already said why; keep serving the last
+                # inventory and try again next time
+                sys.stderr.write('\n')
+            except Exception as e:
+                sys.stderr.write('ERROR: refreshing the inventory failed: %s\n' % e)
+
+    def refresh_daemon_state(self):
+        ''' Rebuilds the inventory from the APIs, updating the cache, and
+        swaps it in for the one being served '''
+
+        self.inventory = self._empty_inventory()
+        self.index = {}
+        self.shared_values = {}
+        refreshed = time()
+        self.do_api_calls_update_cache()
+
+        listing = six.StringIO()
+        self.write_json(self.inventory, listing)
+        self.daemon_state = (listing.getvalue(), self.inventory['_meta']['hostvars'], refreshed)
+
+    def load_daemon_state_from_cache(self):
+        ''' Serves the inventory from the cache until the first refresh '''
+
+        refreshed = time() - self.get_cache_age()
+        listing = six.StringIO()
+        self.write_inventory_from_cache(listing)
+        listing = listing.getvalue()
+        hostvars = json.loads(listing)['_meta']['hostvars']
+        for host_vars in hostvars.values():
+            self.share_values(host_vars)
+        self.daemon_state = (listing, hostvars, refreshed)
+
+    def answer_daemon_request(self, request):
+        ''' Returns the output of --list for "list" and of --host for
+        "host <name>", or an empty string for anything else. Unknown hosts
+        get an empty string too, so the client falls back to --host's own
+        cache refresh and API lookup, and so does every request once the
+        inventory is older than daemon_max_age. '''
+
+        listing, hostvars, refreshed = self.daemon_state
+        if time() - refreshed >= self.daemon_max_age:
+            return ''
+        if request == 'list':
+            return listing
+        if request.startswith('host ') and request[5:] in hostvars:
+            return self.json_format_dict(hostvars[request[5:]], not self.json_compact)
+        return ''
+
+    def request_from_daemon(self):
+        ''' Asks a running daemon for the output of --list or --host. Returns
+        None when no daemon answers, so the caller builds it itself. '''
+
+        if not os.path.exists(self.daemon_socket):
+            return None
+
+        if self.args.host:
+            request = 'host %s\n' % self.args.host
+        else:
+            request = 'list\n'
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(DAEMON_TIMEOUT)
+        chunks = []
+        try:
+            client.connect(self.daemon_socket)
+            client.sendall(request.encode('utf-8'))
+            while True:
+                chunk = client.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except socket.error:
+            return None
+        finally:
+            client.close()
+
+        return b''.join(chunks).decode('utf-8') or None
 
     def load_index_from_cache(self):
         ''' Reads the index from the cache file sets self.index '''
 
+        if self.cache_backend == 'sqlite':
+            with self.connect_to_sqlite_cache() as db:
+                rows = db.execute('SELECT hostname, region, id FROM idx').fetchall()
+            self.index = dict((hostname, [region, instance_id]) for hostname, region, instance_id in rows)
+            return
+
         with open(self.cache_path_index, 'rb') as f:
             self.index = json.load(f)
 
-    def write_to_cache(self, data, filename):
-        ''' Writes data in JSON format to a file '''
+    def connect_to_sqlite_cache(self):
+        ''' Opens the sqlite cache read-only, with the file memory-mapped so
+        lookups only page in what they touch '''
 
-        json_data = self.json_format_dict(data, True)
-        with open(filename, 'w') as f:
-            f.write(json_data)
+        db = sqlite3.connect(self.cache_path_db)
+        db.execute('PRAGMA query_only = ON')
+        db.execute('PRAGMA mmap_size = 268435456')
+        return contextlib.closing(db)
+
+    def write_to_sqlite_cache(self):
+        ''' Writes the inventory, the variables of each host and the index to
+        the sqlite cache. The database is built aside and renamed into place,
+        so readers never see it half written. '''
+
+        # A name of its own, as concurrent refreshes each build a database
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.cache_path_db),
+                                        prefix=os.path.basename(self.cache_path_db) + '.')
+        os.close(fd)
+        try:
+            self.build_sqlite_cache(tmp_path)
+            os.chmod(tmp_path, CACHE_FILE_MODE)
+            self.count('cache_write.bytes', os.path.getsize(tmp_path))
+            os.rename(tmp_path, self.cache_path_db)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def build_sqlite_cache(self, path):
+        ''' Writes the tables of the sqlite cache to a new database file '''
+
+        db = sqlite3.connect(path)
+        try:
+            db.execute('CREATE TABLE inventory (data TEXT NOT NULL)')
+            db.execute('CREATE TABLE hostvars (hostname TEXT PRIMARY KEY, data TEXT NOT NULL)')
+            db.execute('CREATE TABLE idx (hostname TEXT PRIMARY KEY, region TEXT, id TEXT)')
+            db.execute('CREATE TABLE groups (data TEXT NOT NULL)')
+            json_inventory = six.StringIO()
+            self.write_json(self.inventory, json_inventory)
+            db.execute('INSERT INTO inventory VALUES (?)', (json_inventory.getvalue(),))
+            db.executemany('INSERT INTO hostvars VALUES (?, ?)',
+                           ((hostname, self.json_format_dict(host_vars))
+                            for hostname, host_vars in self.inventory['_meta']['hostvars'].items()))
+            db.executemany('INSERT INTO idx VALUES (?, ?, ?)',
+                           ((hostname, region, instance_id) for hostname, (region, instance_id) in self.index.items()))
+            db.execute('INSERT INTO groups VALUES (?)', (self.json_format_dict(self.get_groups(self.inventory)),))
+            db.commit()
+        finally:
+            db.close()
+
+    def load_shard_from_cache(self, shard):
+        ''' Reads the inventory fragment of a (region, service) pair from its
+        cache file '''
+
+        with open(self.cache_path_shard % shard, 'r') as f:
+            return json.load(f)
+
+    @contextlib.contextmanager
+    def replacing_file(self, filename, mode='w'):
+        ''' Opens a temporary file next to filename, and renames it to
+        filename once the block is done with it, so readers never see it half
+        written. The temporary file is removed if the block fails. '''
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=os.path.basename(filename) + '.')
+        try:
+            with os.fdopen(fd, mode) as f:
+                yield f
+            os.chmod(tmp_path, CACHE_FILE_MODE)
+            self.count('cache_write.bytes', os.path.getsize(tmp_path))
+            os.rename(tmp_path, filename)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def write_to_cache(self, data, filename, compact=False):
+        ''' Writes data in JSON format to a file, without any whitespace if
+        compact is True '''
+
+        with self.replacing_file(filename) as f:
+            if compact:
+                json.dump(data, f, separators=(',', ':'))
+            else:
+                self.write_json(data, f)
+
+    def write_hostvars_to_cache(self, hostvars):
+        ''' Writes the variables of each host as a line of its own, and an
+        index of the offset and length of every host's line, so a few hosts
+        can be read without loading the whole cache '''
+
+        offsets = {}
+        offset = 0
+        with self.replacing_file(self.cache_path_hostvars, 'wb') as f:
+            for hostname, host_vars in hostvars.items():
+                line = (JSON_COMPACT_ENCODER.encode([hostname, host_vars]) + '\n').encode('utf-8')
+                f.write(line)
+                offsets[hostname] = [offset, len(line)]
+                offset += len(line)
+        self.write_to_cache(offsets, self.cache_path_hostvars_index, compact=True)
 
     def uncammelize(self, key):
-        temp = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', key)
-        return re.sub('([a-z0-9])([A-Z])', r'\1_\2', temp).lower()
+        try:
+            return self.uncammelize_memo[key]
+        except KeyError:
+            pass
+
+        temp = CAMEL_WORD_RE.sub(r'\1_\2', key)
+        result = CAMEL_CASE_RE.sub(r'\1_\2', temp).lower()
+        self.remember(self.uncammelize_memo, key, result)
+        return result
 
     def to_safe(self, word):
         ''' Converts 'bad' characters in a string to underscores so they can be used as Ansible groups '''
-        regex = "[^A-Za-z0-9\_"
-        if not self.replace_dash_in_groups:
-            regex += "\-"
-        return re.sub(regex + "]", "_", word)
+        try:
+            return self.to_safe_memo[word]
+        except KeyError:
+            pass
+
+        if self.replace_dash_in_groups:
+            result = UNSAFE_CHARS_RE.sub("_", word)
+        else:
+            result = UNSAFE_CHARS_KEEP_DASH_RE.sub("_", word)
+        self.remember(self.to_safe_memo, word, result)
+        return result
+
+    def remember(self, memo, key, value):
+        ''' Stores a result in a memo, emptying it first once it holds
+        SANITIZE_MEMO_SIZE results so it stays bounded '''
+
+        if len(memo) >= SANITIZE_MEMO_SIZE:
+            memo.clear()
+        memo[key] = value
 
     def json_format_dict(self, data, pretty=False):
         ''' Converts a dict to a JSON object and dumps it as a formatted
@@ -1602,6 +3259,43 @@ class Ec2Inventory(object):
         else:
             return json.dumps(data)
 
+    def write_json(self, data, stream, depth=0):
+        ''' Writes a dict as JSON to a file object one entry at a time, so the
+        whole document never has to be held as a single string. Dicts nested
+        up to two levels deep (e.g. _meta.hostvars) are written the same way.
+
+        By default the output matches json_format_dict(data, True). With
+        json_compact it is written without whitespace and in insertion
+        order, which is deterministic and saves sorting the keys. '''
+
+        if self.json_compact:
+            keys = list(data)
+            item_separator, key_separator = ',', ':'
+            indent = closing_indent = ''
+        else:
+            keys = sorted(data)
+            item_separator, key_separator = JSON_PRETTY_ENCODER.item_separator, ': '
+            indent = '\n' + '  ' * (depth + 1)
+            closing_indent = '\n' + '  ' * depth
+
+        if not keys:
+            stream.write('{}')
+            return
+
+        stream.write('{')
+        for i, key in enumerate(keys):
+            if i:
+                stream.write(item_separator)
+            stream.write(indent + json.dumps(key) + key_separator)
+            value = data[key]
+            if isinstance(value, dict) and depth < 2:
+                self.write_json(value, stream, depth + 1)
+            elif self.json_compact:
+                stream.write(JSON_COMPACT_ENCODER.encode(value))
+            else:
+                stream.write(JSON_PRETTY_ENCODER.encode(value).replace('\n', indent))
+        stream.write(closing_indent + '}')
+
 
 if __name__ == '__main__':
     # Run the script
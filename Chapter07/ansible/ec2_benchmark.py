@@ -0,0 +1,670 @@
+#!/usr/bin/env python
+
+'''
+EC2 external inventory benchmark
+================================
+
+Times ec2.py against a synthetic AWS backend, so it can be measured without an
+AWS account or network access. Fake boto, boto3 and ansible.module_utils.ec2
+modules are installed before ec2.py is loaded. They generate the requested
+number of EC2 instances (with tags), RDS instances and ElastiCache clusters in
+every region, and can sleep on every API call to simulate latency:
+
+    python ec2_benchmark.py --regions 4 --instances 5000 --latency 0.05
+    python ec2_benchmark.py --option tag_fetch_strategy=inline --option json_compact=True
+    python ec2_benchmark.py --script /path/to/another/ec2.py
+
+Every run is an `ec2.py --refresh-cache` with a fresh cache directory. The
+table reports the best, median and worst time of each phase over --repeat
+runs:
+
+ - total: the whole run, from reading ec2.ini to the end of the --list output
+ - settings: parsing the arguments and ec2.ini
+ - refresh: do_api_calls_update_cache, from the first API call to the cache
+ - api: time spent in API calls
+ - add: add_instance, add_rds_instance and add_elasticache_*
+ - hostvars: building host variables (part of add)
+ - merge: merging the inventory of each region and service
+ - cache write: writing the cache files (part of refresh)
+ - serialize: write_json and json_format_dict (part of cache write and output)
+ - output: writing the --list output
+
+api, add, hostvars and merge add up the time spent by every thread, so they
+can exceed the refresh time when regions are fetched concurrently.
+'''
+
+import sys
+import os
+import argparse
+import contextlib
+import shutil
+import tempfile
+import threading
+import types
+from collections import defaultdict
+from time import sleep, time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+ACCOUNT_ID = '123456789012'
+
+# Methods of Ec2Inventory timed as each phase. Methods missing from the
+# ec2.py being measured are skipped.
+PHASE_METHODS = [
+    ('settings', ['parse_cli_args', 'read_settings']),
+    ('refresh', ['do_api_calls_update_cache']),
+    ('add', ['add_instance', 'add_rds_instance', 'add_elasticache_cluster',
+             'add_elasticache_node', 'add_elasticache_replication_group']),
+    ('hostvars', ['get_host_info_dict_from_instance', 'get_host_info_dict_from_describe_dict']),
+    ('merge', ['merge_shard']),
+    ('cache write', ['write_to_cache', 'write_hostvars_to_cache', 'write_to_sqlite_cache']),
+    ('serialize', ['write_json', 'json_format_dict']),
+]
+
+PHASES = ['total', 'settings', 'refresh', 'api', 'add', 'hostvars', 'merge', 'cache write', 'serialize', 'output']
+
+
+class PhaseTimer(object):
+    ''' Adds up the time spent in each phase, across threads. A phase that is
+    entered again from within itself is only timed once. '''
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def reset(self):
+        self.totals.clear()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        active = self.local.__dict__.setdefault('active', set())
+        if name in active:
+            yield
+            return
+
+        active.add(name)
+        start = time()
+        try:
+            yield
+        finally:
+            elapsed = time() - start
+            active.discard(name)
+            with self.lock:
+                self.totals[name] += elapsed
+
+    def wrap(self, func, name):
+        ''' Returns func, timed as the given phase '''
+
+        def timed(*args, **kwargs):
+            with self.phase(name):
+                return func(*args, **kwargs)
+        return timed
+
+
+class FakeBackend(object):
+    ''' The synthetic AWS account: the data of every region, the latency of
+    API calls and their count '''
+
+    def __init__(self, args, timer):
+        self.regions = ['bench-region-%d' % i for i in range(args.regions)]
+        self.instances = args.instances
+        self.tags = args.tags
+        self.rds = args.rds
+        self.elasticache = args.elasticache
+        self.latency = args.latency
+        self.page_size = args.page_size
+        self.timer = timer
+        self.calls = 0
+        self.lock = threading.Lock()
+
+        # Generated up front, so it isn't part of the timings
+        self.data = dict((region, self.generate(r, region)) for r, region in enumerate(self.regions))
+
+    def generate(self, r, region):
+        return {
+            'instances': [FakeInstance(r, region, i, self.tags) for i in range(self.instances)],
+            'rds': [FakeDBInstance(r, region, i) for i in range(self.rds)],
+            'clusters': [fake_cache_cluster(r, region, i) for i in range(self.elasticache)],
+            'replication_groups': [fake_replication_group(r, region, i) for i in range(0, self.elasticache, 2)],
+        }
+
+    @contextlib.contextmanager
+    def call(self):
+        ''' Wraps the body of every fake API call '''
+
+        with self.lock:
+            self.calls += 1
+        with self.timer.phase('api'):
+            if self.latency:
+                sleep(self.latency)
+            yield
+
+    def page(self, items, marker):
+        ''' Returns a page of items and the marker of the next page, if any '''
+
+        start = int(marker or 0)
+        end = start + self.page_size
+        return items[start:end], (str(end) if end < len(items) else None)
+
+
+class FakeRegionInfo(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeGroup(object):
+
+    def __init__(self, group_id, name):
+        self.id = group_id
+        self.name = name
+
+
+class FakeInstanceState(object):
+
+    def __init__(self, code, name):
+        self.code = code
+        self.name = name
+
+
+class FakePlacement(object):
+
+    def __init__(self, zone):
+        self.zone = zone
+
+
+class FakeBlockDevice(object):
+
+    def __init__(self, volume_id):
+        self.volume_id = volume_id
+
+
+class FakeInstance(object):
+    ''' An EC2 instance with the attributes of a boto.ec2.instance.Instance.
+    Values repeat across instances the way they do in a real fleet. '''
+
+    def __init__(self, r, region, i, tags):
+        self.id = 'i-%02x%06x' % (r, i)
+        self.region = FakeRegionInfo(region)
+        self._state = FakeInstanceState(80, 'stopped') if i % 10 == 9 else FakeInstanceState(16, 'running')
+        self._previous_state = None
+        self._placement = FakePlacement('%s%s' % (region, 'abc'[i % 3]))
+        self.image_id = 'ami-%08x' % (i % 7)
+        self.instance_type = ['t2.micro', 'm4.large', 'c4.xlarge', 'r4.2xlarge'][i % 4]
+        self.key_name = 'key-%d' % (i % 3)
+        self.vpc_id = 'vpc-%08x' % r
+        self.subnet_id = 'subnet-%08x' % (i % 6)
+        self.ip_address = '54.%d.%d.%d' % (r, i // 250 % 250, i % 250)
+        self.private_ip_address = '10.%d.%d.%d' % (r, i // 250 % 250, i % 250)
+        self.public_dns_name = 'ec2-54-%d-%d-%d.compute.amazonaws.com' % (r, i // 250 % 250, i % 250)
+        self.private_dns_name = 'ip-10-%d-%d-%d.ec2.internal' % (r, i // 250 % 250, i % 250)
+        self.groups = [FakeGroup('sg-%08x' % (i % 5), 'web-%d' % (i % 5)), FakeGroup('sg-%08x' % 255, 'default')]
+        self.block_device_mapping = {'/dev/xvda': FakeBlockDevice('vol-%08x' % i)}
+        self.launch_time = '2017-%02d-01T00:00:00.000Z' % (i % 12 + 1)
+        self.monitored = False
+        self.ami_launch_index = 0
+        self.architecture = 'x86_64'
+        self.hypervisor = 'xen'
+        self.root_device_name = '/dev/xvda'
+        self.root_device_type = 'ebs'
+        self.virtualization_type = 'hvm'
+        self.platform = None
+        self.tags = {}
+
+        self.all_tags = {'Name': 'host-%d-%d' % (r, i)}
+        for t in range(1, tags):
+            self.all_tags['tag%d' % t] = 'value-%d' % (i % (t + 1))
+        # Tags returned with the instances are documented as unreliable
+        self.tags_missing = i % 11 == 0
+
+    @property
+    def state(self):
+        return self._state.name
+
+    @property
+    def state_code(self):
+        return self._state.code
+
+    @property
+    def previous_state(self):
+        return None
+
+    @property
+    def previous_state_code(self):
+        return 0
+
+    @property
+    def placement(self):
+        return self._placement.zone
+
+
+class FakeReservation(object):
+
+    def __init__(self, instances):
+        self.owner_id = ACCOUNT_ID
+        self.instances = instances
+
+
+class FakeTag(object):
+
+    def __init__(self, res_id, name, value):
+        self.res_id = res_id
+        self.name = name
+        self.value = value
+
+
+class FakeResultSet(list):
+    marker = None
+
+
+class FakeEC2Connection(object):
+    profile_name = None
+
+    def __init__(self, backend, region):
+        self.backend = backend
+        self.region = region
+
+    def get_all_instances(self, instance_ids=None, filters=None):
+        with self.backend.call():
+            instances = [instance for instance in self.backend.data[self.region]['instances']
+                         if matches_filters(instance, instance_ids, filters)]
+            for instance in instances:
+                instance.tags = {} if instance.tags_missing else dict(instance.all_tags)
+            return [FakeReservation(instances[i:i + 3]) for i in range(0, len(instances), 3)]
+
+    def get_all_tags(self, filters=None):
+        with self.backend.call():
+            instance_ids = set(filters['resource-id'])
+            return [FakeTag(instance.id, name, value)
+                    for instance in self.backend.data[self.region]['instances'] if instance.id in instance_ids
+                    for name, value in instance.all_tags.items()]
+
+
+def matches_filters(instance, instance_ids, filters):
+    ''' Applies the instance filters the fake backend knows about; others
+    match every instance '''
+
+    if instance_ids and instance.id not in instance_ids:
+        return False
+    for key, values in (filters or {}).items():
+        if not isinstance(values, list):
+            values = [values]
+        if key == 'instance-state-name' and instance.state not in values:
+            return False
+        if key == 'instance-id' and instance.id not in values:
+            return False
+        if key == 'instance-type' and instance.instance_type not in values:
+            return False
+        if key.startswith('tag:') and instance.all_tags.get(key[4:]) not in values:
+            return False
+    return True
+
+
+class FakeDBSubnetGroup(object):
+
+    def __init__(self, vpc_id):
+        self.vpc_id = vpc_id
+
+
+class FakeNamed(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeDBInstance(object):
+    ''' An RDS instance with the attributes of a boto.rds.dbinstance.DBInstance '''
+
+    def __init__(self, r, region, i):
+        self.id = 'db-%d-%d' % (r, i)
+        self.status = 'available'
+        self.endpoint = ('db-%d-%d.%s.rds.amazonaws.com' % (r, i, region), 3306)
+        self.availability_zone = '%sa' % region
+        self.instance_class = 'db.m4.large'
+        self.subnet_group = FakeDBSubnetGroup('vpc-%08x' % r)
+        self.security_group = FakeNamed('default')
+        self.engine = 'mysql'
+        self.parameter_group = FakeNamed('default.mysql5.7')
+        self.allocated_storage = 100
+
+
+class FakeRDSConnection(object):
+
+    def __init__(self, backend, region):
+        self.backend = backend
+        self.region = region
+
+    def get_all_dbinstances(self, marker=None):
+        with self.backend.call():
+            instances, next_marker = self.backend.page(self.backend.data[self.region]['rds'], marker)
+            result = FakeResultSet(instances)
+            result.marker = next_marker
+            return result
+
+
+def fake_cache_cluster(r, region, i):
+    cluster_id = 'cache-%d-%d' % (r, i)
+    return {
+        'CacheClusterId': cluster_id,
+        'CacheClusterStatus': 'available',
+        'ConfigurationEndpoint': None,
+        'CacheNodes': [{
+            'CacheNodeId': '0001',
+            'CacheNodeStatus': 'available',
+            'Endpoint': {'Address': '%s-0001.%s.cache.amazonaws.com' % (cluster_id, region), 'Port': 6379},
+        }],
+        'PreferredAvailabilityZone': '%sa' % region,
+        'CacheNodeType': 'cache.m4.large',
+        'SecurityGroups': [{'SecurityGroupId': 'sg-%08x' % 254, 'Status': 'active'}],
+        'Engine': 'redis',
+        'CacheParameterGroup': {'CacheParameterGroupName': 'default.redis3.2',
+                                'ParameterApplyStatus': 'in-sync', 'CacheNodeIdsToReboot': []},
+        'ReplicationGroupId': 'group-%d-%d' % (r, i - i % 2),
+        'NumCacheNodes': 1,
+    }
+
+
+def fake_replication_group(r, region, i):
+    group_id = 'group-%d-%d' % (r, i)
+    return {
+        'ReplicationGroupId': group_id,
+        'Status': 'available',
+        'Description': 'benchmark',
+        'MemberClusters': ['cache-%d-%d' % (r, i), 'cache-%d-%d' % (r, i + 1)],
+        'NodeGroups': [{
+            'PrimaryEndpoint': {'Address': '%s.%s.cache.amazonaws.com' % (group_id, region), 'Port': 6379},
+            'NodeGroupMembers': [{'CurrentRole': 'primary', 'CacheClusterId': 'cache-%d-%d' % (r, i),
+                                  'ReadEndpoint': {'Address': 'cache-%d-%d.%s' % (r, i, region), 'Port': 6379}}],
+        }],
+    }
+
+
+class FakeElastiCacheConnection(object):
+
+    def __init__(self, backend, region):
+        self.backend = backend
+        self.region = region
+
+    def describe_cache_clusters(self, cache_cluster_id=None, max_records=None, marker=None, show_cache_node_info=None):
+        with self.backend.call():
+            clusters, next_marker = self.backend.page(self.backend.data[self.region]['clusters'], marker)
+            return {'DescribeCacheClustersResponse': {'DescribeCacheClustersResult': {
+                'CacheClusters': clusters, 'Marker': next_marker}}}
+
+    def describe_replication_groups(self, replication_group_id=None, max_records=None, marker=None):
+        with self.backend.call():
+            groups, next_marker = self.backend.page(self.backend.data[self.region]['replication_groups'], marker)
+            return {'DescribeReplicationGroupsResponse': {'DescribeReplicationGroupsResult': {
+                'ReplicationGroups': groups, 'Marker': next_marker}}}
+
+
+class FakeBoto3Client(object):
+    ''' The boto3 RDS and STS clients '''
+
+    def __init__(self, backend, region):
+        self.backend = backend
+        self.region = region
+
+    def list_tags_for_resource(self, ResourceName=None):
+        with self.backend.call():
+            return {'TagList': [{'Key': 'Name', 'Value': ResourceName.split(':')[-1]}]}
+
+    def describe_db_instances(self, **kwargs):
+        with self.backend.call():
+            return {'DBInstances': [{'DBInstanceIdentifier': instance.id,
+                                     'DBInstanceArn': 'arn:aws:rds:%s:%s:db:%s' % (self.region, ACCOUNT_ID, instance.id)}
+                                    for instance in self.backend.data[self.region]['rds']]}
+
+    def describe_db_clusters(self, Marker=None, **kwargs):
+        with self.backend.call():
+            return {'DBClusters': []}
+
+    def get_caller_identity(self):
+        with self.backend.call():
+            return {'Account': ACCOUNT_ID}
+
+
+class FakeIAMUser(object):
+    arn = 'arn:aws:iam::%s:user/benchmark' % ACCOUNT_ID
+
+
+class FakeIAMConnection(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get_user(self):
+        with self.backend.call():
+            return FakeIAMUser()
+
+
+class FakeRoute53Connection(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get_zones(self):
+        with self.backend.call():
+            return []
+
+
+class FakeBotoServerError(Exception):
+
+    def __init__(self, status, reason, body=None):
+        super(FakeBotoServerError, self).__init__(status, reason, body)
+        self.status = status
+        self.reason = reason
+        self.body = body
+        self.error_code = None
+        self.message = reason
+
+
+class FakeBotoConfig(object):
+
+    def has_option(self, section, option):
+        return False
+
+    def get(self, section, option, default=None):
+        return default
+
+
+def install_fake_modules(backend):
+    ''' Puts the fake boto, boto3 and ansible.module_utils.ec2 modules in
+    sys.modules, where ec2.py imports them from '''
+
+    def module(name, **attributes):
+        fake = types.ModuleType(name)
+        fake.__dict__.update(attributes)
+        sys.modules[name] = fake
+        return fake
+
+    ec2 = module('boto.ec2', EC2Connection=FakeEC2Connection,
+                 regions=lambda **kwargs: [FakeRegionInfo(region) for region in backend.regions],
+                 connect_to_region=lambda region, **kwargs: FakeEC2Connection(backend, region))
+    rds = module('boto.rds', connect_to_region=lambda region, **kwargs: FakeRDSConnection(backend, region))
+    elasticache = module('boto.elasticache',
+                         connect_to_region=lambda region, **kwargs: FakeElastiCacheConnection(backend, region))
+    route53 = module('boto.route53', Route53Connection=lambda **kwargs: FakeRoute53Connection(backend))
+    sts = module('boto.sts')
+    exception = module('boto.exception', BotoServerError=FakeBotoServerError)
+    module('boto', ec2=ec2, rds=rds, elasticache=elasticache, route53=route53, sts=sts, exception=exception,
+           config=FakeBotoConfig(), connect_iam=lambda **kwargs: FakeIAMConnection(backend))
+    module('boto3')
+
+    module_utils_ec2 = module('ansible.module_utils.ec2',
+                              boto3_inventory_conn=lambda conn_type, resource, region, **kwargs:
+                              FakeBoto3Client(backend, region))
+    module_utils = module('ansible.module_utils', ec2=module_utils_ec2)
+    module('ansible', module_utils=module_utils)
+
+
+def load_inventory_module(path):
+    ''' Loads ec2.py as a module, without running it '''
+
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source('ec2_inventory', path)
+
+    spec = importlib.util.spec_from_file_location('ec2_inventory', path)
+    inventory_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(inventory_module)
+    return inventory_module
+
+
+class CountingSink(object):
+    ''' Stands in for stdout, counting what is written to it '''
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+    def flush(self):
+        pass
+
+
+def run_once(inventory_module, backend, timer, options):
+    ''' Runs ec2.py --refresh-cache with a fresh cache directory. Returns
+    the time of each phase, the size of the --list output, the number of
+    hosts and the number of API calls. '''
+
+    cache_dir = tempfile.mkdtemp(prefix='ec2-benchmark-')
+    ini_path = os.path.join(cache_dir, 'ec2.ini')
+    settings = {
+        'regions': 'all',
+        'regions_exclude': '',
+        'destination_variable': 'public_dns_name',
+        'vpc_destination_variable': 'private_ip_address',
+        'route53': 'False',
+        'rds': str(backend.rds > 0),
+        'elasticache': str(backend.elasticache > 0),
+        'include_rds_clusters': 'False',
+        'cache_path': cache_dir,
+        'cache_max_age': '300',
+    }
+    settings.update(options)
+    with open(ini_path, 'w') as f:
+        f.write('[ec2]\n')
+        for option, value in sorted(settings.items()):
+            f.write('%s = %s\n' % (option, value))
+
+    saved = sys.argv, sys.stdout, dict(os.environ)
+    sys.argv = ['ec2.py', '--refresh-cache']
+    sys.stdout = sink = CountingSink()
+    os.environ['EC2_INI_PATH'] = ini_path
+    os.environ['AWS_ACCESS_KEY_ID'] = 'AKIABENCHMARK'
+    os.environ['AWS_SECRET_ACCESS_KEY'] = 'benchmark'
+    os.environ.pop('AWS_PROFILE', None)
+    timer.reset()
+    calls = backend.calls
+    try:
+        start = time()
+        inventory = inventory_module.Ec2Inventory()
+        total = time() - start
+    finally:
+        sys.argv, sys.stdout = saved[0], saved[1]
+        os.environ.clear()
+        os.environ.update(saved[2])
+        shutil.rmtree(cache_dir)
+
+    phases = dict(timer.totals)
+    phases['total'] = total
+    # ec2.py times its output phase itself; for scripts that don't, the
+    # output is whatever the settings and the refresh leave of the run
+    stats = getattr(inventory, 'stats', {})
+    if 'phase.output.seconds' in stats:
+        phases['output'] = stats['phase.output.seconds']
+    else:
+        phases['output'] = total - phases.get('settings', 0.0) - phases.get('refresh', 0.0)
+    hosts = len(inventory.inventory['_meta']['hostvars'])
+    return phases, sink.size, hosts, backend.calls - calls
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark ec2.py against a synthetic AWS backend')
+    parser.add_argument('--script', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ec2.py'),
+                        help='ec2.py to benchmark (default: the one next to this script)')
+    parser.add_argument('--regions', type=int, default=4,
+                        help='Number of regions (default: 4)')
+    parser.add_argument('--instances', type=int, default=1000,
+                        help='EC2 instances per region (default: 1000)')
+    parser.add_argument('--tags', type=int, default=5,
+                        help='Tags per EC2 instance (default: 5)')
+    parser.add_argument('--rds', type=int, default=0,
+                        help='RDS instances per region (default: 0)')
+    parser.add_argument('--elasticache', type=int, default=0,
+                        help='ElastiCache clusters per region (default: 0)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds every API call takes (default: 0)')
+    parser.add_argument('--page-size', type=int, default=100,
+                        help='Results per page of the paginated APIs (default: 100)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs (default: 3)')
+    parser.add_argument('--option', action='append', default=[], metavar='NAME=VALUE',
+                        help='Set an ec2.ini option, may be repeated')
+    parser.add_argument('--json', action='store_true', default=False,
+                        help='Write the results as JSON instead of a table')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    options = {}
+    for option in args.option:
+        if '=' not in option:
+            sys.exit('--option takes NAME=VALUE, not %s' % option)
+        name, value = option.split('=', 1)
+        options[name.strip()] = value.strip()
+
+    timer = PhaseTimer()
+    backend = FakeBackend(args, timer)
+    install_fake_modules(backend)
+    inventory_module = load_inventory_module(args.script)
+
+    for phase, methods in PHASE_METHODS:
+        for method in methods:
+            if hasattr(inventory_module.Ec2Inventory, method):
+                setattr(inventory_module.Ec2Inventory, method,
+                        timer.wrap(getattr(inventory_module.Ec2Inventory, method), phase))
+
+    runs = []
+    for i in range(args.repeat):
+        runs.append(run_once(inventory_module, backend, timer, options))
+
+    phases = dict((phase, sorted(run[0].get(phase, 0.0) for run in runs)) for phase in PHASES)
+    output_size, hosts, calls = runs[-1][1:]
+
+    if args.json:
+        print(json.dumps({
+            'script': args.script,
+            'settings': dict((name, value) for name, value in vars(args).items() if name not in ['script', 'json']),
+            'phases': phases,
+            'output_bytes': output_size,
+            'hosts': hosts,
+            'api_calls': calls,
+        }, sort_keys=True, indent=2))
+        return
+
+    print('%s: %d regions x %d instances, %d tags, %d RDS, %d ElastiCache, %gs latency, %d runs' % (
+        args.script, args.regions, args.instances, args.tags, args.rds, args.elasticache, args.latency, args.repeat))
+    if options:
+        print('options: %s' % ', '.join('%s=%s' % option for option in sorted(options.items())))
+    print('')
+    print('%-12s %10s %10s %10s' % ('phase', 'best', 'median', 'worst'))
+    for phase in PHASES:
+        times = phases[phase]
+        print('%-12s %9.3fs %9.3fs %9.3fs' % (phase, times[0], times[len(times) // 2], times[-1]))
+    print('')
+    print('%d hosts, %d bytes of --list output, %d API calls per run' % (hosts, output_size, calls))
+
+
+if __name__ == '__main__':
+    main()